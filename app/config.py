@@ -31,12 +31,25 @@ class Settings(BaseSettings):
     whatsapp_business_public_key: Optional[SecretStr] = None
     whatsapp_business_private_key: Optional[SecretStr] = None
     whatsapp_business_private_key_password: Optional[SecretStr] = None
+    # Graph API client (shared by all sends)
+    whatsapp_http2: bool = True
+    whatsapp_max_connections: int = 50
+    whatsapp_max_keepalive_connections: int = 20
+    whatsapp_timeout_s: float = 10.0
+    whatsapp_max_tries: int = 4
+    # Threads that decrypt flow requests, and how many requests may wait for one
+    flow_crypto_workers: int = 4
+    flow_crypto_max_queue: int = 64
+    # Serialized flow screens per (screen, subject, catalog version)
+    flow_payload_cache_enabled: bool = True
+    flow_payload_cache_max_entries: int = 256
 
     # Flows settings
     onboarding_flow_id: Optional[str] = None
     select_subjects_flow_id: Optional[str] = None
     select_classes_flow_id: Optional[str] = None
     flow_token_encryption_key: Optional[SecretStr] = None
+    flow_token_ttl_s: int = 7 * 24 * 60 * 60
 
     # Rate limit settings
     daily_message_limit: int
@@ -48,6 +61,49 @@ class Settings(BaseSettings):
     # Business environment
     business_env: bool = False  # Default if not found in .env
 
+    # Inbound message queue settings (acknowledge webhooks before running the LLM)
+    message_queue_enabled: bool = False
+    message_queue_backend: Literal["memory", "postgres"] = "memory"
+    message_queue_workers: int = 16
+    # Events waiting per worker; the webhook answers 503 (WhatsApp delivers the message
+    # again later) when a worker's memory queue is full, postgres events wait in the table
+    message_queue_max_depth: int = 100
+    # Chat turns run concurrently once their message is stored, at most this many at a
+    # time (keep it within message_coordinator_pool_size with the postgres coordinator)
+    message_queue_max_running: int = 16
+    message_queue_poll_interval_ms: int = 200
+    message_queue_visibility_timeout_s: int = 300
+    message_queue_max_attempts: int = 3  # Failed events are only retried with postgres
+    message_queue_retry_delay_s: float = 5.0  # Doubled for every further attempt
+
+    # Per-user message buffering while the LLM runs; use postgres with several app processes
+    message_coordinator_backend: Literal["memory", "postgres"] = "memory"
+    message_coordinator_pool_size: int = 10
+
+    # Recent messages of active users are kept in memory (only safe with a single process)
+    history_cache_enabled: bool = True
+    history_cache_max_users: int = 1000
+    history_cache_messages_per_user: int = 20
+
+    # Resource ids per teacher, invalidated when they select classes
+    resource_cache_max_users: int = 10_000
+    resource_cache_ttl_s: int = 10 * 60
+
+    # Messages stored by concurrent turns within this window share one INSERT (0 disables)
+    message_write_coalesce_ms: int = 5
+    message_write_max_batch: int = 500
+    # Send the reply without waiting for its messages to be stored; at most this many turns
+    # wait to be stored
+    message_write_behind_enabled: bool = True
+    message_write_max_pending: int = 1000
+
+    # The subjects and classes catalog is reloaded on changes (LISTEN/NOTIFY) and on a timer
+    catalog_listen_enabled: bool = True
+    catalog_refresh_interval_s: int = 5 * 60
+
+    # How long a WhatsApp message ID is remembered in memory to drop webhook retries
+    message_dedup_ttl_s: int = 24 * 60 * 60
+
     @field_validator("business_env", mode="before")
     @classmethod
     def parse_business_env(cls, v):
@@ -93,6 +149,47 @@ class LLMSettings(BaseSettings):
     exercise_generator_model: str = llm_model_options["llama_70b"]
     embedding_model: str = embedder_model_options["bge-large"]
 
+    # Prompt token budget (system prompt, history and new messages) per model
+    context_token_budgets: dict = {
+        llm_model_options["llama_405b"]: 6000,
+        llm_model_options["llama_70b"]: 8000,
+    }
+    default_context_token_budget: int = 8000
+    # Tool outputs of earlier turns are cut to this size when the budget is exceeded
+    stale_tool_output_max_tokens: int = 200
+
+    # Wait for a pause in a burst of messages before calling the LLM. Every message then
+    # waits at least debounce_quiet_ms before its reply is generated, so it is off (0) by
+    # default; the buffering and cancelling of replies to bursts work without it
+    debounce_quiet_ms: int = 0
+    debounce_max_wait_ms: int = 3000
+
+    # Turns older than the most recent ones are folded into a running summary per user
+    conversation_summary_enabled: bool = True
+    summary_keep_recent_messages: int = 6
+    summary_min_new_messages: int = 6
+    summary_max_words: int = 200
+
+    # Tool calls of one LLM turn run concurrently, each with its own timeout
+    tool_timeout_s: float = 30.0
+    max_concurrent_tool_calls: int = 4
+
+    # Concurrent embedding requests within this window are sent as one batch
+    embedding_batch_window_ms: int = 5
+    embedding_max_batch_size: int = 64
+
+    # Reuse answers to near-identical first-turn questions on the same resources
+    response_cache_enabled: bool = False
+    response_cache_max_distance: float = 0.05  # cosine distance
+    response_cache_ttl_s: int = 7 * 24 * 60 * 60
+    # A question counts as a first turn if the user sent nothing for this long before it
+    response_cache_session_gap_s: int = 60 * 60
+
+    # Query embedding cache (in-memory LRU plus an optional Postgres table)
+    embedding_cache_max_bytes: int = 64 * 1024 * 1024
+    embedding_cache_ttl_s: int = 7 * 24 * 60 * 60
+    embedding_cache_persistent: bool = False
+
 
 def initialize_settings():
     settings = Settings()
@@ -0,0 +1,140 @@
+"""
+This module keeps per-user data the chat path reads on every turn in memory: the recent
+messages of active users and the resources each teacher can access.
+
+The history cache is write-through: messages are added when they are stored by this process,
+in conversation order (created_at, id) like the history read from the database.
+It is only correct while one process handles all messages of a user (which the inbound
+queue guarantees within a process), so it can be switched off for multi-process setups.
+"""
+
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.database.models import Message
+from app.utils.cache_utils import LRUCache
+
+
+def _conversation_order(message: Message) -> Tuple[datetime, int]:
+    return message.created_at, message.id
+
+
+class HistoryCache:
+    def __init__(self, max_users: int, messages_per_user: int, enabled: bool = True):
+        self.logger = logging.getLogger(__name__)
+        self.max_users = max_users
+        self.messages_per_user = messages_per_user
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        # user_id -> ring buffer of their most recent messages, least recently used first
+        self._histories: OrderedDict[int, Deque[Message]] = OrderedDict()
+        # user_id -> whether a message was stored while their history was being read
+        self._filling: Dict[int, bool] = {}
+
+    def get(self, user_id: int, limit: int) -> Optional[List[Message]]:
+        """Return the last `limit` messages of a user (oldest first), or None on a miss."""
+        history = self._histories.get(user_id) if self.enabled else None
+        if history is None or limit > self.messages_per_user:
+            self.misses += 1
+            return None
+
+        self._histories.move_to_end(user_id)
+        self.hits += 1
+        return list(history)[-limit:]
+
+    def begin_fill(self, user_id: int) -> None:
+        """Call before reading a history from the database that will be passed to fill."""
+        if self.enabled:
+            self._filling[user_id] = False
+
+    def cancel_fill(self, user_id: int) -> None:
+        self._filling.pop(user_id, None)
+
+    def fill(self, user_id: int, messages: List[Message]) -> None:
+        """Cache the history of a user as read from the database (oldest first)."""
+        # A message stored during the read may be missing from it, so don't cache it
+        if self._filling.pop(user_id, True):
+            return
+        self._histories[user_id] = deque(messages, maxlen=self.messages_per_user)
+        self._histories.move_to_end(user_id)
+        while len(self._histories) > self.max_users:
+            self._histories.popitem(last=False)
+
+    def append(self, messages: List[Message]) -> None:
+        """Add newly stored messages to the histories that are cached."""
+        for message in messages:
+            if message.user_id in self._filling:
+                self._filling[message.user_id] = True
+            history = self._histories.get(message.user_id)
+            if history is None:
+                continue
+            position = _conversation_order(message)
+            if not history or _conversation_order(history[-1]) <= position:
+                history.append(message)
+            else:
+                # With write-behind, a turn's messages can be stored after the user's
+                # next message, sort them into place (a full history drops the oldest)
+                ordered = sorted([*history, message], key=_conversation_order)
+                history.clear()
+                history.extend(ordered)
+
+    def invalidate(self, user_id: int) -> None:
+        self._histories.pop(user_id, None)
+        if user_id in self._filling:
+            self._filling[user_id] = True
+
+    def clear(self) -> None:
+        self._histories.clear()
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._histories),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total if total else 0.0, 3),
+        }
+
+
+class ResourceCache:
+    """
+    Caches the resource ids each teacher can access. They only change when the teacher
+    picks new classes, which invalidates the entry. The TTL bounds how long another
+    process (or a change to classes_resources) can leave an entry stale.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.cache = LRUCache(max_entries=max_users, ttl=ttl)
+
+    def get(self, user_id: int) -> Optional[Tuple[int, ...]]:
+        """Return the cached resource ids (possibly empty) or None on a miss."""
+        return self.cache.get(user_id)
+
+    def put(self, user_id: int, resource_ids: List[int]) -> None:
+        self.cache.put(user_id, tuple(resource_ids))
+
+    def invalidate(self, user_id: int) -> None:
+        self.cache.invalidate(user_id)
+
+    @property
+    def stats(self) -> dict:
+        return self.cache.stats
+
+
+history_cache = HistoryCache(
+    max_users=settings.history_cache_max_users,
+    messages_per_user=settings.history_cache_messages_per_user,
+    # Other processes may store messages for the same user when buffering is distributed
+    enabled=settings.history_cache_enabled
+    and settings.message_coordinator_backend == "memory",
+)
+
+resource_cache = ResourceCache(
+    max_users=settings.resource_cache_max_users,
+    ttl=settings.resource_cache_ttl_s,
+)
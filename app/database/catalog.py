@@ -0,0 +1,198 @@
+"""
+This module keeps an in-process snapshot of the curriculum catalog (subjects and their
+classes), which the flow screens are rendered from. The resources of a teacher's classes
+are looked up (and cached) per teacher, see get_user_resources.
+
+The catalog only changes when an admin loads new curriculum, so the snapshot is loaded at
+startup and reloaded when a trigger on the catalog tables sends a notification on the
+catalog_changed channel. A reload on a timer catches changes whose notification was
+missed, e.g. while the listening connection was down.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlmodel import select
+
+from app.config import settings
+from app.database.engine import get_database_url, get_session
+from app.database.enums import SubjectClassStatus
+from app.database.models import Class, Subject
+
+CATALOG_CHANNEL = "catalog_changed"
+# Loading curriculum changes the tables in many statements, reload once they settle
+NOTIFY_DEBOUNCE_S = 1.0
+
+
+class CatalogSnapshot(NamedTuple):
+    version: int
+    # Subjects with at least one active class, as get_available_subjects returns them
+    subjects: List[Dict[str, str]]
+    # subject_id -> {"subject_name", "classes"}, as get_subject_and_classes returns it
+    subject_classes: Dict[int, Dict[str, Any]]
+
+
+class Catalog:
+    """The snapshot's lists and dicts are shared between requests, don't modify them."""
+
+    def __init__(self, refresh_interval_s: int, listen: bool = True):
+        self.logger = logging.getLogger(__name__)
+        self.refresh_interval_s = refresh_interval_s
+        self.listen = listen
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._load_lock = asyncio.Lock()
+        self._engine: AsyncEngine | None = None
+        self._listener: Optional[AsyncConnection] = None
+        # The asyncpg connection of the listener, to tell whether it is still alive
+        self._listener_driver: Any = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._notify_handle: Optional[asyncio.TimerHandle] = None
+        self._reloads: set[asyncio.Task] = set()
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version if self._snapshot else 0
+
+    async def snapshot(self) -> CatalogSnapshot:
+        if self._snapshot is None:
+            await self.reload()
+        return self._snapshot
+
+    async def get_available_subjects(self) -> List[Dict[str, str]]:
+        return (await self.snapshot()).subjects
+
+    async def get_subject_and_classes(self, subject_id: int) -> Dict[str, Any]:
+        subject = (await self.snapshot()).subject_classes.get(int(subject_id))
+        if subject is None:
+            raise Exception(f"Subject with ID {subject_id} not found or has no classes")
+        return subject
+
+    async def reload(self) -> CatalogSnapshot:
+        """Load the catalog from the database, the version only changes if it did."""
+        async with self._load_lock:
+            async with get_session() as session:
+                subject_rows = (
+                    await session.execute(
+                        select(Subject.id, Subject.name)
+                        .join(Class, Class.subject_id == Subject.id)
+                        .where(Class.status == SubjectClassStatus.active)
+                        .distinct()
+                        .order_by(Subject.id)
+                    )
+                ).fetchall()
+                class_rows = (
+                    await session.execute(
+                        select(
+                            Subject.id.label("subject_id"),
+                            Subject.name.label("subject_name"),
+                            Class.id,
+                            Class.name,
+                        )
+                        .join(Class, Class.subject_id == Subject.id)
+                        .order_by(Subject.id, Class.id)
+                    )
+                ).fetchall()
+
+            subjects = [{"id": str(row.id), "title": row.name} for row in subject_rows]
+            subject_classes: Dict[int, Dict[str, Any]] = {}
+            for row in class_rows:
+                subject = subject_classes.setdefault(
+                    row.subject_id, {"subject_name": row.subject_name, "classes": []}
+                )
+                subject["classes"].append({"id": str(row.id), "title": row.name})
+
+            previous = self._snapshot
+            snapshot = CatalogSnapshot(
+                version=self.version,
+                subjects=subjects,
+                subject_classes=subject_classes,
+            )
+            if previous is None or snapshot[1:] != previous[1:]:
+                snapshot = snapshot._replace(version=self.version + 1)
+                self.logger.info(
+                    f"Loaded catalog version {snapshot.version}: {len(subject_classes)} "
+                    f"subjects, {len(class_rows)} classes"
+                )
+            self._snapshot = snapshot
+            return snapshot
+
+    async def start(self) -> None:
+        await self.reload()
+        if self.listen:
+            await self._listen()
+        self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def _listen(self) -> None:
+        # LISTEN needs a connection of its own for as long as the app runs
+        if self._engine is None:
+            self._engine = create_async_engine(
+                get_database_url(), pool_size=1, max_overflow=0
+            )
+        try:
+            self._listener = await self._engine.connect()
+            raw_connection = await self._listener.get_raw_connection()
+            self._listener_driver = raw_connection.driver_connection
+            await self._listener_driver.add_listener(CATALOG_CHANNEL, self._on_notify)
+        except Exception as e:
+            self.logger.error(f"Failed to listen for catalog changes: {e}")
+            await self._close_listener()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        # Called on the event loop by asyncpg, once per changed statement
+        self.logger.debug(f"Catalog table {payload} changed")
+        if self._notify_handle is not None:
+            self._notify_handle.cancel()
+        self._notify_handle = asyncio.get_running_loop().call_later(
+            NOTIFY_DEBOUNCE_S, self._schedule_reload
+        )
+
+    def _schedule_reload(self) -> None:
+        self._notify_handle = None
+        task = asyncio.create_task(self._safe_reload())
+        self._reloads.add(task)
+        task.add_done_callback(self._reloads.discard)
+
+    async def _safe_reload(self) -> None:
+        try:
+            await self.reload()
+        except Exception as e:
+            self.logger.error(f"Failed to reload the catalog: {e}")
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval_s)
+            if self.listen and (
+                self._listener_driver is None or self._listener_driver.is_closed()
+            ):
+                await self._close_listener()
+                await self._listen()
+            await self._safe_reload()
+
+    async def _close_listener(self) -> None:
+        self._listener_driver = None
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+        if self._notify_handle is not None:
+            self._notify_handle.cancel()
+        await asyncio.gather(*self._reloads, return_exceptions=True)
+        await self._close_listener()
+        if self._engine is not None:
+            await self._engine.dispose()
+
+
+catalog = Catalog(
+    refresh_interval_s=settings.catalog_refresh_interval_s,
+    listen=settings.catalog_listen_enabled,
+)
@@ -1,6 +1,11 @@
-from datetime import datetime
-from typing import Any, Dict, List, Optional
-from sqlalchemy import text
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+import json
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, insert, literal, text, tuple_, union_all
+from sqlalchemy.dialects.postgresql import array, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from sqlmodel import select
 import logging
 
@@ -13,45 +18,123 @@ from app.database.models import (
     Role,
     UserState,
     Subject,
+    InboundEvent,
+    PendingMessage,
+    ResponseCacheEntry,
+)
+from app.database.enums import (
+    InboundEventStatus,
+    MessageRole,
+    OnboardingState,
+    SubjectClassStatus,
 )
-from app.database.enums import SubjectClassStatus
 from app.database.engine import get_session
-from app.utils import embedder
+from app.database.cache import history_cache, resource_cache
+from app.utils.embedder import embedding_client
 
 logger = logging.getLogger(__name__)
 
 # TODO: Add custom Exceptions for better error handling
 
 
-async def get_or_create_user(wa_id: str, name: Optional[str] = None) -> User:
+# When set to a list, the ids of the chunks returned by the vector searches are added to it
+retrieved_chunk_ids: ContextVar[Optional[List[int]]] = ContextVar(
+    "retrieved_chunk_ids", default=None
+)
+
+
+def _record_retrieved_chunks(chunks: List[Chunk]) -> None:
+    collected = retrieved_chunk_ids.get()
+    if collected is not None:
+        collected.extend(chunk.id for chunk in chunks)
+
+
+async def ingest_user_message(
+    wa_id: str,
+    content: Optional[str],
+    wa_message_id: Optional[str] = None,
+    name: Optional[str] = None,
+    reprocess: bool = False,
+) -> Tuple[User, Optional[Message], Optional[List[int]]]:
     """
-    Get existing user or create new one if they don't exist.
-    Handles all database operations and error logging.
+    Store an inbound message as one unit of work: upsert the user, insert the message and
+    (for active users) look up their resources, in a single session and transaction.
+
+    Args:
+        wa_id: The WhatsApp ID of the sender
+        content: The message text
+        wa_message_id: The WhatsApp message ID, used to drop redelivered messages
+        name: The sender's WhatsApp profile name, only used for new users
+        reprocess: Return the already stored message instead of None, for retries of an
+            event that failed after its message was stored
+
+    Returns:
+        The user, the stored message (None if it had already been stored) and the
+        resource ids the user can access (empty if there are none, None if they weren't
+        looked up because the user isn't active or the message was a duplicate)
     """
+    now = datetime.now(timezone.utc)
     async with get_session() as session:
         try:
-            # First try to get existing user
-            statement = select(User).where(User.wa_id == wa_id).with_for_update()
-            result = await session.execute(statement)
-            user = result.scalar_one_or_none()
-            if user:
-                await session.refresh(user)
-                return user
-            # Create new user if they don't exist
-            new_user = User(
-                name=name,
-                wa_id=wa_id,
-                state=UserState.new,
-                role=Role.teacher,
-            )
-            session.add(new_user)
-            await session.flush()  # Get the ID without committing
-            await session.refresh(new_user)
-            logger.info(f"Created new user with wa_id: {wa_id}")
-            return new_user
+            # Creates the user or marks their latest message, both return the row
+            user_statement = (
+                pg_insert(User)
+                .values(
+                    name=name,
+                    wa_id=wa_id,
+                    state=UserState.new,
+                    onboarding_state=OnboardingState.new,
+                    role=Role.teacher,
+                    selected_class_ids=[],
+                    last_message_at=now,
+                    created_at=now,
+                    updated_at=now,
+                )
+                .on_conflict_do_update(
+                    index_elements=[User.wa_id],
+                    set_={"last_message_at": now, "updated_at": now},
+                )
+                .returning(User)
+            )
+            user = (
+                await session.scalars(
+                    user_statement, execution_options={"populate_existing": True}
+                )
+            ).one()
+
+            # The unique wa_message_id makes redelivered messages a no-op
+            message_statement = (
+                pg_insert(Message)
+                .values(
+                    user_id=user.id,
+                    role=MessageRole.user,
+                    content=content,
+                    wa_message_id=wa_message_id,
+                    created_at=now,
+                )
+                .on_conflict_do_nothing(index_elements=[Message.wa_message_id])
+                .returning(Message)
+            )
+            inserted = (await session.scalars(message_statement)).one_or_none()
+            message = inserted
+            if message is None and reprocess:
+                message = (
+                    await session.scalars(
+                        select(Message).where(Message.wa_message_id == wa_message_id)
+                    )
+                ).one_or_none()
+
+            resource_ids = None
+            if message is not None and user.state == UserState.active:
+                resource_ids = await _load_user_resources(session, user.id)
         except Exception as e:
-            logger.error(f"Failed to get or create user for wa_id {wa_id}: {str(e)}")
-            raise Exception(f"Failed to get or create user: {str(e)}")
+            logger.error(f"Failed to ingest message from {wa_id}: {str(e)}")
+            raise Exception(f"Failed to ingest message: {str(e)}")
+
+    # Only cache the message once the transaction has been committed
+    if inserted is not None:
+        history_cache.append([inserted])
+    return user, message, resource_ids
 
 
 async def get_user_by_waid(wa_id: str) -> Optional[User]:
@@ -90,6 +173,7 @@ async def add_teacher_class(user: User, class_ids: List[int]) -> None:
                     teacher_class = TeacherClass(teacher_id=user.id, class_id=class_id)
                     session.add(teacher_class)
             await session.commit()
+            resource_cache.invalidate(user.id)
             logger.info(f"Added classes {class_ids} for user {user.id}")
         except Exception as e:
             logger.error(f"Failed to add teacher class: {str(e)}")
@@ -137,51 +221,149 @@ async def update_user(user: User) -> User:
 async def get_user_message_history(
     user_id: int, limit: int = 10
 ) -> Optional[List[Message]]:
+    # Active conversations are served from the write-through cache
+    cached = history_cache.get(user_id, limit)
+    if cached is not None:
+        return cached or None
+
+    history_cache.begin_fill(user_id)
     async with get_session() as session:
         try:
-            # TODO: Make the database order this by default to reduce repeated operations
+            # Walks ix_messages_user_id_created_at_id, no sort needed
             statement = (
                 select(Message)
                 .where(Message.user_id == user_id)
-                .order_by(Message.created_at.desc())
-                .limit(limit)
+                .order_by(Message.created_at.desc(), Message.id.desc())
+                .limit(max(limit, history_cache.messages_per_user))
             )
 
             result = await session.execute(statement)
-            messages = result.scalars().all()
-
-            # If no messages found, return empty list
-            if not messages:
-                logger.debug(f"No message history found for user {user_id}")
-                return None
-
             # Convert to list and reverse to get chronological order (oldest first)
-            return list(reversed(messages))
-
+            messages = list(reversed(result.scalars().all()))
         except Exception as e:
+            history_cache.cancel_fill(user_id)
             logger.error(
                 f"Failed to retrieve message history for user {user_id}: {str(e)}"
             )
             raise Exception(f"Failed to retrieve message history: {str(e)}")
 
+    history_cache.fill(user_id, messages)
+
+    # If no messages found, return None
+    if not messages:
+        logger.debug(f"No message history found for user {user_id}")
+        return None
+    return messages[-limit:]
+
+
+async def get_user_message_page(
+    user_id: int, before_id: Optional[int] = None, limit: int = 50
+) -> List[Message]:
+    """
+    Get a page of a user's messages, newest first, for export and admin tooling.
+
+    Args:
+        user_id: The user whose messages to page through
+        before_id: Only return messages older than this message (the last id of the previous page)
+        limit: The maximum number of messages in the page
+
+    Returns:
+        List[Message]: The messages, newest first (empty when there are no more)
+    """
+    async with get_session() as session:
+        try:
+            # Keyset pagination: seek in ix_messages_user_id_created_at_id instead of OFFSET
+            statement = select(Message).where(Message.user_id == user_id)
+            if before_id is not None:
+                cursor = aliased(Message)
+                statement = statement.where(
+                    tuple_(Message.created_at, Message.id)
+                    < select(cursor.created_at, cursor.id)
+                    .where(cursor.id == before_id, cursor.user_id == user_id)
+                    .scalar_subquery()
+                )
+            statement = statement.order_by(
+                Message.created_at.desc(), Message.id.desc()
+            ).limit(limit)
+
+            result = await session.execute(statement)
+            return list(result.scalars().all())
+        except Exception as e:
+            logger.error(
+                f"Failed to retrieve message page for user {user_id} before {before_id}: {str(e)}"
+            )
+            raise Exception(f"Failed to retrieve message page: {str(e)}")
+
 
 async def create_new_messages(messages: List[Message]) -> List[Message]:
-    """Optimized bulk message creation"""
+    """
+    Store messages with a single INSERT ... VALUES ... RETURNING statement and set their
+    ids, instead of flushing one ORM INSERT per message.
+    """
     if not messages:
         return []
 
     async with get_session() as session:
         try:
-            # Add all messages to the session
-            session.add_all(messages)
-            await session.flush()  # Get IDs without committing
-            return messages
+            statement = insert(Message).returning(
+                Message.id, Message.created_at, sort_by_parameter_order=True
+            )
+            result = await session.execute(
+                statement, [_message_values(message) for message in messages]
+            )
+            for message, row in zip(messages, result.all()):
+                message.id = row.id
+                message.created_at = row.created_at
         except Exception as e:
             logger.error(
                 f"Unexpected error creating messages for user {messages[0].user_id}: {str(e)}"
             )
             raise Exception(f"Failed to create messages: {str(e)}")
 
+    # Only cache the messages once the transaction has been committed
+    history_cache.append(messages)
+    return messages
+
+
+async def copy_messages(messages: List[Message]) -> int:
+    """
+    Store a large number of messages with COPY, e.g. for backfills. Much faster than
+    INSERT, but the ids are not returned and the history cache is not updated.
+    """
+    if not messages:
+        return 0
+
+    columns = [
+        column.name for column in Message.__table__.columns if column.name != "id"
+    ]
+    records = []
+    for message in messages:
+        values = _message_values(message)
+        # COPY sends json columns as text
+        if values["tool_calls"] is not None:
+            values["tool_calls"] = json.dumps(values["tool_calls"])
+        records.append(tuple(values[column] for column in columns))
+
+    async with get_session() as session:
+        try:
+            connection = await session.connection()
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                Message.__tablename__, records=records, columns=columns
+            )
+        except Exception as e:
+            logger.error(f"Failed to copy {len(messages)} messages: {str(e)}")
+            raise Exception(f"Failed to copy messages: {str(e)}")
+    return len(records)
+
+
+def _message_values(message: Message) -> Dict[str, Any]:
+    return {
+        column.name: getattr(message, column.name)
+        for column in Message.__table__.columns
+        if column.name != "id"
+    }
+
 
 async def create_new_message(message: Message) -> Message:
     """
@@ -198,6 +380,7 @@ async def create_new_message(message: Message) -> Message:
             # Refresh the message to get its ID and other DB-populated fields
             await session.refresh(message)
 
+            history_cache.append([message])
             return message
 
         except Exception as e:
@@ -205,14 +388,115 @@ async def create_new_message(message: Message) -> Message:
             raise Exception(f"Failed to create message: {str(e)}")
 
 
-async def vector_search(query: str, n_results: int, where: dict) -> List[Chunk]:
-    try:
-        query_vector = embedder.get_embedding(query)
-    except Exception as e:
-        logger.error(f"Failed to get embedding for query {query}: {str(e)}")
-        raise Exception(f"Failed to get embedding for query: {str(e)}")
+async def get_unsummarized_messages(
+    user_id: int, after_id: Optional[int], limit: int, latest: bool = False
+) -> List[Message]:
+    """
+    Get the oldest (or with latest, the most recent) messages of a user that are not yet
+    part of their conversation summary, i.e. that follow the message after_id in
+    conversation order (created_at, id), oldest first. With write-behind the ids of a
+    turn's messages can be higher than the user's next message.
+    """
+    async with get_session() as session:
+        try:
+            statement = select(Message).where(Message.user_id == user_id)
+            if after_id is not None:
+                summarized = aliased(Message)
+                statement = statement.where(
+                    tuple_(Message.created_at, Message.id)
+                    > select(summarized.created_at, summarized.id)
+                    .where(summarized.id == after_id)
+                    .scalar_subquery()
+                )
+            if latest:
+                statement = statement.order_by(
+                    Message.created_at.desc(), Message.id.desc()
+                )
+            else:
+                statement = statement.order_by(Message.created_at, Message.id)
+            result = await session.execute(statement.limit(limit))
+            messages = list(result.scalars().all())
+            return messages[::-1] if latest else messages
+        except Exception as e:
+            logger.error(
+                f"Failed to retrieve unsummarized messages for user {user_id}: {str(e)}"
+            )
+            raise Exception(f"Failed to retrieve unsummarized messages: {str(e)}")
+
+
+async def update_user_summary(
+    user_id: int, summary: str, summary_message_id: int
+) -> bool:
+    """
+    Store a new conversation summary, unless a summary covering later messages was
+    stored in the meantime. Returns whether the summary was stored.
+    """
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                text(
+                    """
+                    UPDATE users
+                    SET conversation_summary = :summary,
+                        summary_message_id = :summary_message_id,
+                        updated_at = now()
+                    WHERE id = :user_id
+                      AND (
+                        summary_message_id IS NULL
+                        OR (SELECT (created_at, id) FROM messages WHERE id = summary_message_id)
+                           < (SELECT (created_at, id) FROM messages WHERE id = :summary_message_id)
+                      )
+                """
+                ),
+                {
+                    "summary": summary,
+                    "summary_message_id": summary_message_id,
+                    "user_id": user_id,
+                },
+            )
+            return result.rowcount > 0
+        except Exception as e:
+            logger.error(f"Failed to update summary for user {user_id}: {str(e)}")
+            raise Exception(f"Failed to update user summary: {str(e)}")
 
-    # Decode the where dict
+
+async def get_pending_messages(user_id: int) -> List[Message]:
+    """Get the stored messages of a user that are waiting for an LLM reply (oldest first)."""
+    async with get_session() as session:
+        try:
+            statement = (
+                select(Message)
+                .join(PendingMessage, PendingMessage.message_id == Message.id)
+                .where(PendingMessage.user_id == user_id)
+                .order_by(Message.id)
+            )
+            result = await session.execute(statement)
+            return list(result.scalars().all())
+        except Exception as e:
+            logger.error(
+                f"Failed to retrieve pending messages for user {user_id}: {str(e)}"
+            )
+            raise Exception(f"Failed to retrieve pending messages: {str(e)}")
+
+
+async def count_pending_messages(user_id: int) -> int:
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                select(func.count())
+                .select_from(PendingMessage)
+                .where(PendingMessage.user_id == user_id)
+            )
+            return result.scalar_one()
+        except Exception as e:
+            logger.error(
+                f"Failed to count pending messages for user {user_id}: {str(e)}"
+            )
+            raise Exception(f"Failed to count pending messages: {str(e)}")
+
+
+def _build_chunk_filters(where: dict) -> list:
+    """Decode a where dict (column name -> value or list of values) into chunk filters."""
     filters = []
     for key, value in where.items():
         if isinstance(value, list) and len(value) > 1:
@@ -221,6 +505,17 @@ async def vector_search(query: str, n_results: int, where: dict) -> List[Chunk]:
             filters.append(getattr(Chunk, key) == value[0])
         else:
             filters.append(getattr(Chunk, key) == value)
+    return filters
+
+
+async def vector_search(query: str, n_results: int, where: dict) -> List[Chunk]:
+    try:
+        query_vector = await embedding_client.get_embedding(query)
+    except Exception as e:
+        logger.error(f"Failed to get embedding for query {query}: {str(e)}")
+        raise Exception(f"Failed to get embedding for query: {str(e)}")
+
+    filters = _build_chunk_filters(where)
 
     async with get_session() as session:
         try:
@@ -230,12 +525,136 @@ async def vector_search(query: str, n_results: int, where: dict) -> List[Chunk]:
                 .order_by(Chunk.embedding.cosine_distance(query_vector))
                 .limit(n_results)
             )
-            return result.scalars().all()
+            chunks = result.scalars().all()
+            _record_retrieved_chunks(chunks)
+            return chunks
+        except Exception as e:
+            logger.error(f"Failed to search for knowledge: {str(e)}")
+            raise Exception(f"Failed to search for knowledge: {str(e)}")
+
+
+async def vector_search_multi(
+    query_vector: List[float], searches: List[Tuple[dict, int]]
+) -> List[List[Chunk]]:
+    """
+    Run several filtered nearest neighbour searches for the same query vector in one SQL
+    statement (a UNION ALL of one top-k subquery per search).
+
+    Args:
+        query_vector: The precomputed query embedding
+        searches: List of (where, n_results) pairs, see vector_search for the where format
+
+    Returns:
+        List[List[Chunk]]: The chunks of each search (closest first), in the order of searches
+    """
+    if not searches:
+        return []
+
+    subqueries = []
+    for index, (where, n_results) in enumerate(searches):
+        distance = Chunk.embedding.cosine_distance(query_vector)
+        subqueries.append(
+            select(
+                Chunk.id.label("chunk_id"),
+                literal(index).label("search_index"),
+                distance.label("distance"),
+            )
+            .where(*_build_chunk_filters(where))
+            .order_by(distance)
+            .limit(n_results)
+        )
+    ranked = union_all(*subqueries).subquery("ranked")
+
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                select(Chunk, ranked.c.search_index)
+                .join(ranked, Chunk.id == ranked.c.chunk_id)
+                .order_by(ranked.c.search_index, ranked.c.distance)
+            )
+            grouped: List[List[Chunk]] = [[] for _ in searches]
+            for chunk, search_index in result.all():
+                grouped[search_index].append(chunk)
+            _record_retrieved_chunks([chunk for chunks in grouped for chunk in chunks])
+            return grouped
         except Exception as e:
             logger.error(f"Failed to search for knowledge: {str(e)}")
             raise Exception(f"Failed to search for knowledge: {str(e)}")
 
 
+async def find_cached_response(
+    resource_key: str, query_vector: List[float], max_distance: float, ttl: int
+) -> Optional[ResponseCacheEntry]:
+    """Get the closest unexpired cached response for a resource set, if it is close enough."""
+    distance = ResponseCacheEntry.embedding.cosine_distance(query_vector)
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                select(ResponseCacheEntry, distance.label("distance"))
+                .where(
+                    ResponseCacheEntry.resource_key == resource_key,
+                    ResponseCacheEntry.created_at
+                    > datetime.now(timezone.utc) - timedelta(seconds=ttl),
+                )
+                .order_by(distance)
+                .limit(1)
+            )
+            row = result.first()
+            if row is None or row.distance > max_distance:
+                return None
+            return row.ResponseCacheEntry
+        except Exception as e:
+            logger.error(f"Failed to look up cached response: {str(e)}")
+            raise Exception(f"Failed to look up cached response: {str(e)}")
+
+
+async def create_cached_response(entry: ResponseCacheEntry) -> None:
+    async with get_session() as session:
+        try:
+            session.add(entry)
+        except Exception as e:
+            logger.error(f"Failed to store cached response: {str(e)}")
+            raise Exception(f"Failed to store cached response: {str(e)}")
+
+
+async def invalidate_cached_responses(resource_ids: List[int]) -> int:
+    """Delete the cached responses that drew on any of the resources (e.g. after their chunks changed)."""
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                delete(ResponseCacheEntry).where(
+                    ResponseCacheEntry.resource_ids.op("&&")(array(resource_ids))
+                )
+            )
+            return result.rowcount
+        except Exception as e:
+            logger.error(
+                f"Failed to invalidate cached responses for resources {resource_ids}: {str(e)}"
+            )
+            raise Exception(f"Failed to invalidate cached responses: {str(e)}")
+
+
+async def _load_user_resources(session: AsyncSession, user_id: int) -> List[int]:
+    """Get the resource ids of a teacher from the cache, or with one query on a miss."""
+    cached = resource_cache.get(user_id)
+    if cached is not None:
+        return list(cached)
+
+    # Use text() for a more efficient raw SQL query
+    query = text(
+        """
+        SELECT DISTINCT cr.resource_id
+        FROM teachers_classes tc
+        JOIN classes_resources cr ON tc.class_id = cr.class_id
+        WHERE tc.teacher_id = :user_id
+    """
+    )
+    result = await session.execute(query, {"user_id": user_id})
+    resource_ids = [row[0] for row in result.fetchall()]
+    resource_cache.put(user_id, resource_ids)
+    return resource_ids
+
+
 async def get_user_resources(user: User) -> Optional[List[int]]:
     """
     Get all resource IDs accessible to a user through their class assignments.
@@ -252,19 +671,7 @@ async def get_user_resources(user: User) -> Optional[List[int]]:
     """
     async with get_session() as session:
         try:
-            # Use text() for a more efficient raw SQL query
-            query = text(
-                """
-                SELECT DISTINCT cr.resource_id
-                FROM teachers_classes tc
-                JOIN classes_resources cr ON tc.class_id = cr.class_id
-                WHERE tc.teacher_id = :user_id
-            """
-            )
-
-            result = await session.execute(query, {"user_id": user.id})
-            resource_ids = [row[0] for row in result.fetchall()]
-
+            resource_ids = await _load_user_resources(session, user.id)
             if not resource_ids:
                 logger.warning(f"No resources found for user {user.wa_id}")
                 return None
@@ -383,6 +790,188 @@ async def generate_class_info(user: User) -> Dict[str, List[str]]:
             raise Exception(f"Failed to generate class info: {str(e)}")
 
 
+async def enqueue_inbound_event(wa_id: str, payload: dict) -> int:
+    """
+    Persist a raw webhook event so it can be processed by the queue workers.
+
+    Returns:
+        int: The ID of the queued event
+    """
+    async with get_session() as session:
+        try:
+            event = InboundEvent(wa_id=wa_id, payload=payload)
+            session.add(event)
+            await session.flush()
+            return event.id
+        except Exception as e:
+            logger.error(f"Failed to enqueue inbound event for {wa_id}: {str(e)}")
+            raise Exception(f"Failed to enqueue inbound event: {str(e)}")
+
+
+async def claim_inbound_events(
+    limit: int, visibility_timeout: int, retry_delay: float
+) -> List[InboundEvent]:
+    """
+    Claim the next batch of queued events for processing.
+
+    An event is only claimable once the earlier events of its wa_id are stored (running),
+    so the messages of a user are stored in order even when several workers (or
+    processes) poll the queue. Events stuck in processing or running for longer than the
+    visibility timeout (e.g. after a crash) become claimable again, and failed attempts
+    are retried with exponential backoff.
+
+    Args:
+        limit: Maximum number of events to claim
+        visibility_timeout: Seconds after which a processing event is reclaimed
+        retry_delay: Seconds before the first retry of a failed event, doubled after that
+
+    Returns:
+        List[InboundEvent]: The claimed events, oldest first
+    """
+    async with get_session() as session:
+        try:
+            query = text(
+                """
+                WITH claimable AS (
+                    SELECT e.id
+                    FROM inbound_events e
+                    WHERE (
+                        (
+                            e.status = :pending
+                            AND (
+                                e.attempts = 0
+                                OR e.updated_at < now() - make_interval(
+                                    secs => :retry_delay * power(2, e.attempts - 1)
+                                )
+                            )
+                        )
+                        OR (
+                            e.status IN (:processing, :running)
+                            AND e.updated_at < now() - make_interval(secs => :timeout)
+                        )
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM inbound_events p
+                        WHERE p.wa_id = e.wa_id
+                          AND p.id < e.id
+                          AND p.status IN (:pending, :processing)
+                    )
+                    ORDER BY e.id
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE inbound_events
+                SET status = :processing, attempts = attempts + 1, updated_at = now()
+                FROM claimable
+                WHERE inbound_events.id = claimable.id
+                RETURNING inbound_events.id, inbound_events.wa_id,
+                          inbound_events.payload, inbound_events.attempts
+            """
+            )
+            result = await session.execute(
+                query,
+                {
+                    "pending": InboundEventStatus.pending,
+                    "processing": InboundEventStatus.processing,
+                    "running": InboundEventStatus.running,
+                    "timeout": float(visibility_timeout),
+                    "retry_delay": float(retry_delay),
+                    "limit": limit,
+                },
+            )
+            events = [
+                InboundEvent(
+                    id=row.id,
+                    wa_id=row.wa_id,
+                    payload=row.payload,
+                    attempts=row.attempts,
+                    status=InboundEventStatus.processing,
+                )
+                for row in result.fetchall()
+            ]
+            return sorted(events, key=lambda event: event.id)
+        except Exception as e:
+            logger.error(f"Failed to claim inbound events: {str(e)}")
+            raise Exception(f"Failed to claim inbound events: {str(e)}")
+
+
+async def mark_inbound_event_running(event_id: int) -> None:
+    """Mark an event whose message is stored, so the user's next event can be claimed."""
+    async with get_session() as session:
+        try:
+            await session.execute(
+                text(
+                    """
+                    UPDATE inbound_events
+                    SET status = :running, updated_at = now()
+                    WHERE id = :id
+                """
+                ),
+                {"running": InboundEventStatus.running, "id": event_id},
+            )
+        except Exception as e:
+            logger.error(f"Failed to mark inbound event {event_id} running: {str(e)}")
+            raise Exception(f"Failed to mark inbound event as running: {str(e)}")
+
+
+async def complete_inbound_event(event_id: int) -> None:
+    """Remove a successfully processed event from the queue."""
+    async with get_session() as session:
+        try:
+            await session.execute(
+                text("DELETE FROM inbound_events WHERE id = :id"), {"id": event_id}
+            )
+        except Exception as e:
+            logger.error(f"Failed to complete inbound event {event_id}: {str(e)}")
+            raise Exception(f"Failed to complete inbound event: {str(e)}")
+
+
+async def fail_inbound_event(event_id: int, error: str, retry: bool) -> None:
+    """
+    Record a processing failure. The event is either returned to the queue for another
+    attempt or parked as failed for manual inspection.
+    """
+    status = InboundEventStatus.pending if retry else InboundEventStatus.failed
+    async with get_session() as session:
+        try:
+            await session.execute(
+                text(
+                    """
+                    UPDATE inbound_events
+                    SET status = :status, error = :error, updated_at = now()
+                    WHERE id = :id
+                """
+                ),
+                {"status": status, "error": error, "id": event_id},
+            )
+        except Exception as e:
+            logger.error(f"Failed to mark inbound event {event_id} as failed: {str(e)}")
+            raise Exception(f"Failed to mark inbound event as failed: {str(e)}")
+
+
+async def release_inbound_events(event_ids: List[int]) -> None:
+    """Return claimed but unprocessed events to the queue (e.g. on shutdown)."""
+    if not event_ids:
+        return
+
+    async with get_session() as session:
+        try:
+            await session.execute(
+                text(
+                    """
+                    UPDATE inbound_events
+                    SET status = :pending, attempts = attempts - 1, updated_at = now()
+                    WHERE id = ANY(:ids)
+                """
+                ),
+                {"pending": InboundEventStatus.pending, "ids": event_ids},
+            )
+        except Exception as e:
+            logger.error(f"Failed to release inbound events {event_ids}: {str(e)}")
+            raise Exception(f"Failed to release inbound events: {str(e)}")
+
+
 # async def add_default_subjects_and_classes() -> None:
 #     """
 #     Add a default subject called Geography with ID 1 and a class called Secondary Form 2 with ID 1.
@@ -512,6 +1101,7 @@ async def update_user_selected_classes(
 
             formatted_selected_classes = [int(class_id) for class_id in new_class_ids]
             await add_teacher_class(user, formatted_selected_classes)
+            resource_cache.invalidate(user.id)
             logger.debug(f"Teacher-class relationships updated for user {user.wa_id}")
 
             logger.info(
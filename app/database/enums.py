@@ -66,3 +66,10 @@ class ChunkType(str, Enum):
     table = "table"
     other = "other"
     # NOTE: add more types as needed, but keep clean structure with good segregation
+
+
+class InboundEventStatus(str, Enum):
+    pending = "pending"
+    processing = "processing"
+    running = "running"  # The message is stored, its reply is being generated
+    failed = "failed"
@@ -20,6 +20,7 @@ import sqlalchemy as sa
 
 from app.database.enums import (
     GradeLevel,
+    InboundEventStatus,
     OnboardingState,
     Role,
     UserState,
@@ -75,6 +76,9 @@ class User(SQLModel, table=True):
     birthday: Optional[date] = Field(default=None, sa_type=Date)
     region: Optional[str] = Field(default=None, max_length=50)
     last_message_at: Optional[datetime] = Field(sa_type=DateTime(timezone=True))
+    # Running summary of the conversation up to and including message summary_message_id
+    conversation_summary: Optional[str] = Field(default=None, sa_type=sa.Text)
+    summary_message_id: Optional[int] = Field(default=None)
     created_at: Optional[datetime] = Field(
         default_factory=lambda: datetime.now(timezone.utc),
         sa_type=DateTime(timezone=True),  # type: ignore
@@ -160,10 +164,19 @@ class TeacherClass(SQLModel, table=True):
 
 class Message(SQLModel, table=True):
     __tablename__ = "messages"
+    # Serves the newest-first history of a user (and keyset pages of it) from the index
+    __table_args__ = (
+        Index(
+            "ix_messages_user_id_created_at_id",
+            "user_id",
+            sa.desc("created_at"),
+            sa.desc("id"),
+        ),
+    )
 
     """ FIELDS """
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="users.id", index=True, ondelete="CASCADE")
+    user_id: int = Field(foreign_key="users.id", ondelete="CASCADE")
     role: str = Field(max_length=20)
     content: Optional[str] = Field(default=None)  # None when tool_calls present
 
@@ -172,6 +185,10 @@ class Message(SQLModel, table=True):
     tool_call_id: Optional[str] = Field(default=None)
     # TODO: Make tool_name actually be used (right now its always None)
     tool_name: Optional[str] = Field(default=None, max_length=50)
+    # The WhatsApp message ID (wamid) of inbound messages, used to drop webhook retries
+    wa_message_id: Optional[str] = Field(
+        default=None, max_length=128, unique=True, index=True
+    )
     created_at: Optional[datetime] = Field(
         default_factory=lambda: datetime.now(timezone.utc),
         sa_type=DateTime(timezone=True),  # type: ignore
@@ -370,3 +387,84 @@ class Chunk(SQLModel, table=True):
     """ RELATIONSHIPS """
     resource_: Optional["Resource"] = Relationship(back_populates="resource_chunks")
     section_: Optional["Section"] = Relationship(back_populates="section_chunks")
+
+
+class InboundEvent(SQLModel, table=True):
+    __tablename__ = "inbound_events"
+    __table_args__ = (Index("ix_inbound_events_status_id", "status", "id"),)
+
+    """ FIELDS """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    wa_id: str = Field(max_length=20, index=True)
+    payload: dict = Field(sa_column=Column(JSON, nullable=False))
+    status: str = Field(default=InboundEventStatus.pending, max_length=20)
+    attempts: int = Field(default=0)
+    error: Optional[str] = Field(default=None)
+    created_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),  # type: ignore
+        sa_column_kwargs={"server_default": sa.func.now()},
+        nullable=False,
+    )
+    updated_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),  # type: ignore
+        sa_column_kwargs={"server_default": sa.func.now()},
+        nullable=False,
+    )
+
+
+class EmbeddingCacheEntry(SQLModel, table=True):
+    __tablename__ = "embedding_cache"
+
+    """ FIELDS """
+    model: str = Field(max_length=100, primary_key=True)
+    text_hash: str = Field(max_length=64, primary_key=True)  # sha256 of the text
+    # No fixed dimension so the cache works for any embedding model
+    embedding: Any = Field(sa_column=Column(Vector(), nullable=False))
+    created_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),  # type: ignore
+        sa_column_kwargs={"server_default": sa.func.now()},
+        nullable=False,
+    )
+
+
+class PendingMessage(SQLModel, table=True):
+    """A stored user message that is waiting to be answered by the LLM."""
+
+    __tablename__ = "pending_messages"
+
+    """ FIELDS """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="users.id", index=True, ondelete="CASCADE")
+    message_id: int = Field(foreign_key="messages.id", unique=True, ondelete="CASCADE")
+    created_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),  # type: ignore
+        sa_column_kwargs={"server_default": sa.func.now()},
+        nullable=False,
+    )
+
+
+class ResponseCacheEntry(SQLModel, table=True):
+    """A final answer to a first-turn question, reused for near-identical questions."""
+
+    __tablename__ = "response_cache"
+
+    """ FIELDS """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # The sorted, comma separated ids of the resources the answer could draw on
+    resource_key: str = Field(max_length=255, index=True)
+    resource_ids: List[int] = Field(sa_column=Column(ARRAY(Integer), nullable=False))
+    query: str
+    # Same length as Chunk.embedding
+    embedding: Any = Field(sa_column=Column(Vector(1024)))
+    answer: str
+    chunk_ids: Optional[List[int]] = Field(sa_column=Column(ARRAY(Integer)), default=[])
+    created_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),  # type: ignore
+        sa_column_kwargs={"server_default": sa.func.now()},
+        nullable=False,
+    )
@@ -6,9 +6,18 @@ from contextlib import asynccontextmanager
 from app.security import signature_required
 from app.security import flows_signature_required
 from app.services.whatsapp_service import whatsapp_client
-from app.services.messaging_service import handle_request
+from app.services.messaging_service import handle_request, handle_valid_message
+from app.services.queue_service import inbound_queue
 from app.services.flow_service import flow_client
+from app.utils.flows_util import flow_crypto, flow_crypto_pool
+from app.utils.flow_token import flow_tokens
+from app.services.summary_service import conversation_summarizer
+from app.services.coordination_service import message_coordinator
+from app.services.persistence_service import message_writer
+from app.database.catalog import catalog
 from app.database.engine import db_engine, init_db
+from app.utils.embedder import embedding_client
+from app.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +29,18 @@ async def lifespan(app: FastAPI):
         await init_db()
         logger.info("Database initialized successfully")
 
+        # Flow screens are rendered from the in-memory catalog
+        await catalog.start()
+
+        # Parse the flow keys once instead of on the first flow request
+        if settings.business_env:
+            flow_crypto.load()
+            flow_tokens.load()
+
+        # Start the workers that drain the inbound message queue
+        if settings.message_queue_enabled:
+            await inbound_queue.start(handle_valid_message)
+
         # Additional startup tasks can go here
         logger.info("Application startup completed")
         yield
@@ -28,6 +49,16 @@ async def lifespan(app: FastAPI):
         raise
     finally:
         # Cleanup
+        await inbound_queue.stop()
+        logger.info("Inbound message queue stopped")
+        await catalog.stop()
+        await conversation_summarizer.stop()
+        await message_writer.close()
+        logger.info("Pending message writes stored")
+        await message_coordinator.close()
+        await embedding_client.close()
+        await whatsapp_client.close()
+        flow_crypto_pool.shutdown()
         await db_engine.dispose()
         logger.info("Database connections closed")
 
@@ -0,0 +1,396 @@
+"""
+This module coordinates the per-user message buffer of the LLM pipeline.
+
+Messages a user sends while their previous messages are still being answered are buffered
+and answered together by a single owner. The memory backend does this within one process.
+The postgres backend does it across processes and containers: the buffer is the
+pending_messages table and ownership is a session-level advisory lock on the user. Owners
+waiting for new messages are woken by a notification on the pending_messages channel.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+from app.config import settings
+from app.database.engine import get_database_url
+from app.database.models import Message
+import app.database.db as db
+
+# Advisory lock keys are (namespace, user_id) pairs
+OWNER_LOCK_NAMESPACE = 7401
+MUTEX_LOCK_NAMESPACE = 7402
+PENDING_CHANNEL = "pending_messages"
+# Waiting owners also check the buffer this often, in case a notification was missed
+# (e.g. while the listening connection was down)
+PENDING_POLL_INTERVAL_S = 2.0
+
+
+class MessageProcessor:
+    """Handles processing and batching of messages for a single user."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.lock = asyncio.Lock()
+        self.messages: List[Message] = []
+        self.message_added = asyncio.Event()
+
+    def add_message(self, message: Message) -> None:
+        self.messages.append(message)
+        self.message_added.set()
+
+    def get_pending_messages(self) -> List[Message]:
+        # Concurrent turns may buffer their (already stored) messages out of order
+        return sorted(self.messages, key=lambda message: message.id)
+
+    def clear_messages(self) -> None:
+        self.messages.clear()
+
+    @property
+    def has_messages(self) -> bool:
+        return bool(self.messages)
+
+    @property
+    def is_locked(self) -> bool:
+        return self.lock.locked()
+
+
+class MemoryCoordinator:
+    """Buffers messages in process memory. Only correct with a single app process."""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._processors: Dict[int, MessageProcessor] = {}
+
+    def _get_processor(self, user_id: int) -> MessageProcessor:
+        """Get or create a message processor for a user."""
+        if user_id not in self._processors:
+            self._processors[user_id] = MessageProcessor(user_id)
+        return self._processors[user_id]
+
+    def _cleanup_processor(self, user_id: int) -> None:
+        """Remove processor if it's empty and unlocked."""
+        processor = self._processors.get(user_id)
+        if processor and not processor.has_messages and not processor.is_locked:
+            del self._processors[user_id]
+
+    async def enqueue(self, user_id: int, message: Message) -> bool:
+        """Buffer a message. Returns True if the caller now owns the user's buffer."""
+        processor = self._get_processor(user_id)
+        processor.add_message(message)
+        if processor.is_locked:
+            return False
+        await processor.lock.acquire()
+        return True
+
+    async def get_pending(self, user_id: int) -> List[Message]:
+        return self._get_processor(user_id).get_pending_messages()
+
+    async def pending_count(self, user_id: int) -> int:
+        return len(self._get_processor(user_id).messages)
+
+    async def has_new_messages(self, user_id: int, processed_count: int) -> bool:
+        """Check if new messages arrived during processing."""
+        return len(self._get_processor(user_id).messages) > processed_count
+
+    async def wait_for_new_messages(
+        self, user_id: int, known_count: int, timeout: Optional[float] = None
+    ) -> int:
+        """Wait (up to timeout seconds) for the buffer to grow, return its size."""
+        processor = self._get_processor(user_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while len(processor.messages) <= known_count:
+            processor.message_added.clear()
+            try:
+                await asyncio.wait_for(
+                    processor.message_added.wait(),
+                    max(0.0, deadline - loop.time()) if deadline is not None else None,
+                )
+            except asyncio.TimeoutError:
+                break
+        return len(processor.messages)
+
+    async def try_release(self, user_id: int, processed: List[Message]) -> bool:
+        """
+        Drop the answered messages and give up ownership, unless new messages arrived in
+        the meantime (then the owner has to answer again and False is returned).
+        """
+        processor = self._get_processor(user_id)
+        if len(processor.messages) > len(processed):
+            return False
+        processor.clear_messages()
+        processor.lock.release()
+        self._cleanup_processor(user_id)
+        return True
+
+    async def abort(self, user_id: int) -> None:
+        """Drop the whole buffer and give up ownership after a failure."""
+        processor = self._get_processor(user_id)
+        processor.clear_messages()
+        if processor.is_locked:
+            processor.lock.release()
+        self._cleanup_processor(user_id)
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresCoordinator:
+    """
+    Buffers messages in the pending_messages table so any number of app processes can
+    share it. The owner of a user's buffer holds a session-level advisory lock on a
+    dedicated connection while it runs the LLM. Enqueueing and releasing both take a
+    short transaction-level mutex on the user, so a message is never buffered in the
+    moment between the owner's last check and its unlock.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._engine: AsyncEngine | None = None
+        self._owner_connections: Dict[int, AsyncConnection] = {}
+        # LISTEN needs a connection of its own, shared by all waiting owners
+        self._listen_engine: AsyncEngine | None = None
+        self._listener: Optional[AsyncConnection] = None
+        self._listener_driver: Any = None
+        self._listen_lock = asyncio.Lock()
+        self._waiters: Dict[int, List[asyncio.Event]] = {}
+
+    @property
+    def engine(self) -> AsyncEngine:
+        # Owner connections are held for a whole LLM turn, so they get a pool of their
+        # own and can't starve the queries that run during the turn
+        if self._engine is None:
+            self._engine = create_async_engine(
+                get_database_url(),
+                pool_size=settings.message_coordinator_pool_size,
+                max_overflow=0,
+                pool_pre_ping=True,
+            )
+        return self._engine
+
+    async def enqueue(self, user_id: int, message: Message) -> bool:
+        """Buffer a stored message. Returns True if the caller now owns the user's buffer."""
+        params = {
+            "mutex": MUTEX_LOCK_NAMESPACE,
+            "owner": OWNER_LOCK_NAMESPACE,
+            "user_id": user_id,
+            "message_id": message.id,
+        }
+        conn = await self.engine.connect()
+        try:
+            async with conn.begin():
+                await conn.execute(
+                    text("SELECT pg_advisory_xact_lock(:mutex, :user_id)"), params
+                )
+                await conn.execute(
+                    text(
+                        """
+                        INSERT INTO pending_messages (user_id, message_id)
+                        VALUES (:user_id, :message_id)
+                        ON CONFLICT (message_id) DO NOTHING
+                    """
+                    ),
+                    params,
+                )
+                # Sent on commit, wakes the owner if another process holds the buffer
+                await conn.execute(
+                    text("SELECT pg_notify(:channel, CAST(:user_id AS text))"),
+                    {"channel": PENDING_CHANNEL, "user_id": user_id},
+                )
+                acquired = (
+                    await conn.execute(
+                        text("SELECT pg_try_advisory_lock(:owner, :user_id)"), params
+                    )
+                ).scalar()
+        except Exception:
+            await conn.invalidate()
+            raise
+
+        if not acquired:
+            await conn.close()
+            return False
+        self._owner_connections[user_id] = conn
+        return True
+
+    async def get_pending(self, user_id: int) -> List[Message]:
+        return await db.get_pending_messages(user_id)
+
+    async def pending_count(self, user_id: int) -> int:
+        return await db.count_pending_messages(user_id)
+
+    async def has_new_messages(self, user_id: int, processed_count: int) -> bool:
+        return await db.count_pending_messages(user_id) > processed_count
+
+    async def wait_for_new_messages(
+        self, user_id: int, known_count: int, timeout: Optional[float] = None
+    ) -> int:
+        """Wait (up to timeout seconds) for the buffer to grow, return its size."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else float("inf")
+        # Registered before counting, so a message buffered in between isn't missed
+        notified = asyncio.Event()
+        self._waiters.setdefault(user_id, []).append(notified)
+        try:
+            await self._listen()
+            count = await db.count_pending_messages(user_id)
+            while count <= known_count and loop.time() < deadline:
+                notified.clear()
+                try:
+                    await asyncio.wait_for(
+                        notified.wait(),
+                        min(PENDING_POLL_INTERVAL_S, deadline - loop.time()),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                count = await db.count_pending_messages(user_id)
+            return count
+        finally:
+            waiters = self._waiters[user_id]
+            waiters.remove(notified)
+            if not waiters:
+                del self._waiters[user_id]
+
+    async def _listen(self) -> None:
+        """Start listening for buffered messages, unless the listener is still alive."""
+        async with self._listen_lock:
+            if (
+                self._listener_driver is not None
+                and not self._listener_driver.is_closed()
+            ):
+                return
+            await self._close_listener()
+            if self._listen_engine is None:
+                self._listen_engine = create_async_engine(
+                    get_database_url(), pool_size=1, max_overflow=0
+                )
+            try:
+                self._listener = await self._listen_engine.connect()
+                raw_connection = await self._listener.get_raw_connection()
+                self._listener_driver = raw_connection.driver_connection
+                await self._listener_driver.add_listener(
+                    PENDING_CHANNEL, self._on_notify
+                )
+            except Exception as e:
+                # Waiting owners fall back to checking the buffer every poll interval
+                self.logger.error(f"Failed to listen for buffered messages: {e}")
+                await self._close_listener()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        # Called on the event loop by asyncpg, once per buffered message
+        for notified in self._waiters.get(int(payload), ()):
+            notified.set()
+
+    async def _close_listener(self) -> None:
+        self._listener_driver = None
+        if self._listener is not None:
+            try:
+                await self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def try_release(self, user_id: int, processed: List[Message]) -> bool:
+        """
+        Drop the answered messages and give up ownership, unless new messages arrived in
+        the meantime (then the owner has to answer again and False is returned).
+        """
+        conn = self._owner_connections[user_id]
+        params = {
+            "mutex": MUTEX_LOCK_NAMESPACE,
+            "owner": OWNER_LOCK_NAMESPACE,
+            "user_id": user_id,
+            "message_ids": [message.id for message in processed],
+        }
+        try:
+            async with conn.begin():
+                await conn.execute(
+                    text("SELECT pg_advisory_xact_lock(:mutex, :user_id)"), params
+                )
+                remaining = (
+                    await conn.execute(
+                        text(
+                            """
+                            SELECT count(*) FROM pending_messages
+                            WHERE user_id = :user_id AND message_id <> ALL(:message_ids)
+                        """
+                        ),
+                        params,
+                    )
+                ).scalar()
+                if remaining:
+                    return False
+                await conn.execute(
+                    text(
+                        "DELETE FROM pending_messages WHERE message_id = ANY(:message_ids)"
+                    ),
+                    params,
+                )
+                await conn.execute(
+                    text("SELECT pg_advisory_unlock(:owner, :user_id)"), params
+                )
+        except Exception:
+            await self._drop_owner_connection(user_id)
+            raise
+
+        self._owner_connections.pop(user_id)
+        await conn.close()
+        return True
+
+    async def abort(self, user_id: int) -> None:
+        """Drop the whole buffer and give up ownership after a failure."""
+        conn = self._owner_connections.get(user_id)
+        if conn is None:
+            return
+        params = {
+            "mutex": MUTEX_LOCK_NAMESPACE,
+            "owner": OWNER_LOCK_NAMESPACE,
+            "user_id": user_id,
+        }
+        try:
+            async with conn.begin():
+                await conn.execute(
+                    text("SELECT pg_advisory_xact_lock(:mutex, :user_id)"), params
+                )
+                await conn.execute(
+                    text("DELETE FROM pending_messages WHERE user_id = :user_id"),
+                    params,
+                )
+                await conn.execute(
+                    text("SELECT pg_advisory_unlock(:owner, :user_id)"), params
+                )
+        except Exception as e:
+            self.logger.error(f"Failed to abort message buffer of {user_id}: {e}")
+            await self._drop_owner_connection(user_id)
+            return
+
+        self._owner_connections.pop(user_id)
+        await conn.close()
+
+    async def _drop_owner_connection(self, user_id: int) -> None:
+        # Closing the database session is the only sure way to release its advisory lock
+        conn = self._owner_connections.pop(user_id, None)
+        if conn is not None:
+            await conn.invalidate()
+            await conn.close()
+
+    async def close(self) -> None:
+        for user_id in list(self._owner_connections):
+            await self._drop_owner_connection(user_id)
+        await self._close_listener()
+        if self._listen_engine is not None:
+            await self._listen_engine.dispose()
+        if self._engine is not None:
+            await self._engine.dispose()
+
+
+def create_coordinator() -> MemoryCoordinator | PostgresCoordinator:
+    if settings.message_coordinator_backend == "postgres":
+        return PostgresCoordinator()
+    return MemoryCoordinator()
+
+
+message_coordinator = create_coordinator()
@@ -0,0 +1,44 @@
+"""
+This module drops repeated deliveries of the same inbound WhatsApp message.
+
+Meta redelivers a webhook whenever it does not get a timely 200, so the same message can
+arrive several times. An in-process TTL set catches retries cheaply, and the unique
+messages.wa_message_id column catches the rest (other workers, restarts).
+"""
+
+import logging
+from typing import Optional
+
+from app.config import settings
+from app.utils.cache_utils import TTLSet
+
+
+class MessageDeduplicator:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._seen = TTLSet(ttl=settings.message_dedup_ttl_s)
+        self.stats = {"checked": 0, "memory_hits": 0, "database_hits": 0}
+
+    def is_duplicate(self, message_id: Optional[str]) -> bool:
+        """Check the in-process set, before any database or LLM work is done."""
+        self.stats["checked"] += 1
+        if message_id and message_id in self._seen:
+            self.stats["memory_hits"] += 1
+            self.logger.info(f"Dropping repeated delivery of message {message_id}")
+            self.logger.debug(f"Deduplication stats: {self.stats}")
+            return True
+        return False
+
+    def mark_seen(self, message_id: Optional[str]) -> None:
+        if message_id:
+            self._seen.add(message_id)
+
+    def record_database_hit(self, message_id: Optional[str]) -> None:
+        """A retry got past the in-process set but was rejected by the unique column."""
+        self.stats["database_hits"] += 1
+        self.mark_seen(message_id)
+        self.logger.info(f"Dropping already stored message {message_id}")
+        self.logger.debug(f"Deduplication stats: {self.stats}")
+
+
+message_deduplicator = MessageDeduplicator()
@@ -7,27 +7,25 @@ from fastapi.responses import PlainTextResponse, JSONResponse
 from app.utils.background_tasks_utils import add_background_task
 from app.utils.flows_util import (
     create_flow_response_payload,
+    create_select_subjects_payload,
     create_subject_class_payload,
-    decrypt_flow_webhook,
-    decrypt_flow_token,
+    decrypt_flow_webhook_async,
     encrypt_flow_token,
+    flow_crypto,
+    flow_payload_cache,
     get_flow_text,
-    handle_token_validation,
     send_whatsapp_flow_message,
     validate_user,
 )
+from app.database.catalog import catalog
 from app.database.db import (
-    get_subject_and_classes,
     update_user,
-    get_available_subjects,
     update_user_selected_classes,
 )
 from app.database.models import User
+from app.utils.flow_token import FlowTokenClaims, InvalidFlowTokenError, flow_tokens
 from app.services.whatsapp_service import whatsapp_client
 from app.config import settings
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-import base64
 import json
 
 logger = logging.getLogger(__name__)
@@ -41,7 +39,7 @@ class FlowService:
         self, body: dict, background_tasks: BackgroundTasks
     ) -> PlainTextResponse:
         try:
-            decrypted_data = decrypt_flow_webhook(body)
+            decrypted_data = await decrypt_flow_webhook_async(body)
             self.logger.info(f"Decrypted data: {decrypted_data}")
             decrypted_payload = decrypted_data["decrypted_payload"]
             aes_key = decrypted_data["aes_key"]
@@ -70,27 +68,24 @@ class FlowService:
                 status_code=422,
             )
 
+        # The token is decrypted once here, the handlers get its claims
         try:
-            wa_id, flow_id = decrypt_flow_token(flow_token)
-            self.logger.info(f"Flow Action: {action}, Flow ID: {flow_id}")
-        except Exception as e:
+            claims = flow_tokens.decode(flow_token)
+            self.logger.info(f"Flow Action: {action}, Flow ID: {claims.flow_id}")
+        except InvalidFlowTokenError as e:
             self.logger.error(f"Error decrypting flow token: {e}")
             return JSONResponse(
                 content={"error_msg": "Your request has expired please start again"},
                 status_code=422,
             )
 
-        handler = self.get_action_handler(action, flow_id)
+        handler = self.get_action_handler(action, claims.flow_id)
         # Check if the action is a data exchange action and handle accordingly
-        if action in ["data_exchange", "INIT"]:
-            if action == "data_exchange":
-                return await handler(
-                    decrypted_payload, aes_key, initial_vector, background_tasks
-                )
-            else:
-                return await handler(decrypted_payload, aes_key, initial_vector)
-        else:
-            return await handler(decrypted_payload, aes_key, initial_vector)
+        if action == "data_exchange":
+            return await handler(
+                decrypted_payload, aes_key, initial_vector, claims, background_tasks
+            )
+        return await handler(decrypted_payload, aes_key, initial_vector, claims)
 
     def get_action_handler(self, action: str, flow_id: str):
         if flow_id == settings.onboarding_flow_id:
@@ -115,49 +110,36 @@ class FlowService:
             }.get(action, self.handle_unknown_action)
 
     async def handle_select_classes_init_action(
-        self, decrypted_payload: dict, aes_key: bytes, initial_vector: str
+        self,
+        decrypted_payload: dict,
+        aes_key: bytes,
+        initial_vector: str,
+        claims: FlowTokenClaims,
     ) -> PlainTextResponse:
         try:
-            # Use helper functions for token and user validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, _ = handle_token_validation(self.logger, encrypted_flow_token)
-            await validate_user(self.logger, wa_id)
+            await validate_user(self.logger, claims.wa_id)
 
             subject_id = 1  # Hardcoded subject_id as 1, because init action is only used when testing
-            subject_data = await get_subject_and_classes(subject_id)
+            snapshot = await catalog.snapshot()
+            subject_data = await catalog.get_subject_and_classes(subject_id)
             subject_title = subject_data["subject_name"]
             classes = subject_data["classes"]
             logger.debug(f"Subject title for subject ID {subject_id}: {subject_title}")
             logger.debug(f"Available classes for subject ID {subject_id}: {classes}")
 
-            select_class_question_text = (
-                f"Select the class you are in for {subject_title}."
-            )
-            select_class_text = f"This helps us find the best answers for your questions in {subject_title}."
-            no_classes_text = (
-                f"Sorry, currently there are no active classes for {subject_title}."
-            )
-            has_classes = len(classes) > 0
-
-            response_payload = create_flow_response_payload(
-                screen="select_classes",
-                data={
-                    "classes": (
-                        classes
-                        if has_classes
-                        else [
-                            {
-                                "id": "0",
-                                "title": "No classes available",
-                            }
-                        ]
+            response_payload = flow_payload_cache.get(
+                "select_classes",
+                subject_id,
+                snapshot.version,
+                lambda: create_flow_response_payload(
+                    screen="select_classes",
+                    data=create_subject_class_payload(
+                        subject_title=subject_title,
+                        classes=classes,
+                        is_update=False,
+                        subject_id=str(subject_id),
                     ),
-                    "has_classes": has_classes,
-                    "no_classes_text": no_classes_text,
-                    "select_class_text": select_class_text,
-                    "select_class_question_text": select_class_question_text,
-                    "subject_id": str(subject_id),
-                },
+                ),
             )
 
             return await self.process_response(
@@ -175,6 +157,7 @@ class FlowService:
         decrypted_payload: dict,
         aes_key: bytes,
         initial_vector: str,
+        claims: FlowTokenClaims,
         background_tasks: BackgroundTasks,
     ) -> PlainTextResponse:
         try:
@@ -185,10 +168,7 @@ class FlowService:
             self.logger.info("Selected classes: %s", selected_classes)
             self.logger.info("Subject ID: %s", subject_id)
 
-            # Use helper functions for token and user validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, flow_id = handle_token_validation(self.logger, encrypted_flow_token)
-            user = await validate_user(self.logger, wa_id)
+            user = await validate_user(self.logger, claims.wa_id)
 
             if not selected_classes:
                 self.logger.error("No classes selected")
@@ -216,7 +196,9 @@ class FlowService:
             )
 
             response_payload = create_flow_response_payload(
-                screen="SUCCESS", data={}, flow_token=encrypted_flow_token
+                screen="SUCCESS",
+                data={},
+                flow_token=decrypted_payload.get("flow_token"),
             )
             return await self.process_response(
                 response_payload, aes_key, initial_vector
@@ -226,7 +208,11 @@ class FlowService:
             return JSONResponse(content={"error_msg": str(e)}, status_code=422)
 
     async def handle_unknown_action(
-        self, decrypted_payload: dict, aes_key: bytes, initial_vector: str
+        self,
+        decrypted_payload: dict,
+        aes_key: bytes,
+        initial_vector: str,
+        claims: FlowTokenClaims,
     ) -> PlainTextResponse:
         self.logger.warning(
             f"Unknown action received: {decrypted_payload.get('action')}"
@@ -235,13 +221,14 @@ class FlowService:
         return await self.process_response(response_payload, aes_key, initial_vector)
 
     async def handle_onboarding_init_action(
-        self, decrypted_payload: dict, aes_key: bytes, initial_vector: str
+        self,
+        decrypted_payload: dict,
+        aes_key: bytes,
+        initial_vector: str,
+        claims: FlowTokenClaims,
     ) -> PlainTextResponse:
         try:
-            # Use helper functions for token and user validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, flow_id = handle_token_validation(self.logger, encrypted_flow_token)
-            user = await validate_user(self.logger, wa_id)
+            user = await validate_user(self.logger, claims.wa_id)
 
             response_payload = create_flow_response_payload(
                 screen="personal_info",
@@ -258,35 +245,22 @@ class FlowService:
             return JSONResponse(content={"error_msg": str(e)}, status_code=422)
 
     async def handle_select_subjects_init_action(
-        self, decrypted_payload: dict, aes_key: bytes, initial_vector: str
+        self,
+        decrypted_payload: dict,
+        aes_key: bytes,
+        initial_vector: str,
+        claims: FlowTokenClaims,
     ) -> PlainTextResponse:
         try:
-            # Use helper function for token validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, flow_id = handle_token_validation(self.logger, encrypted_flow_token)
-
-            # Get available subjects from the database
-            subjects = await get_available_subjects()
-            logger.debug(f"Available subjects: {subjects}")
-
-            select_subject_text = (
-                "This helps us find the best answers for your questions."
-            )
-            no_subjects_text = "Sorry, currently there are no active subjects."
-            has_subjects = len(subjects) > 0
-
-            response_payload = create_flow_response_payload(
-                screen="select_subjects",
-                data={
-                    "subjects": (
-                        subjects
-                        if has_subjects
-                        else [{"id": "0", "title": "No subjects available"}]
-                    ),  # doing this because the response in whatsapp flows expects a list of subjects with id and title
-                    "has_subjects": has_subjects,
-                    "no_subjects_text": no_subjects_text,
-                    "select_subject_text": select_subject_text,
-                },
+            snapshot = await catalog.snapshot()
+            response_payload = flow_payload_cache.get(
+                "select_subjects",
+                None,
+                snapshot.version,
+                lambda: create_flow_response_payload(
+                    screen="select_subjects",
+                    data=create_select_subjects_payload(snapshot.subjects),
+                ),
             )
             return await self.process_response(
                 response_payload, aes_key, initial_vector
@@ -300,6 +274,7 @@ class FlowService:
         decrypted_payload: dict,
         aes_key: bytes,
         initial_vector: str,
+        claims: FlowTokenClaims,
         background_tasks: BackgroundTasks,
     ) -> PlainTextResponse:
         try:
@@ -310,10 +285,7 @@ class FlowService:
             is_updating = data.get("is_updating", False)
             logger.debug(f"Is updating: {is_updating}")
 
-            # Use helper functions for token and user validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, flow_id = handle_token_validation(self.logger, encrypted_flow_token)
-            user = await validate_user(self.logger, wa_id)
+            user = await validate_user(self.logger, claims.wa_id)
 
             # Add the database update task to the background tasks
             self.logger.info("Creating background task for onboarding data update")
@@ -328,7 +300,7 @@ class FlowService:
             response_payload = create_flow_response_payload(
                 screen="SUCCESS",
                 data={},  # Empty data since SUCCESS screen handles its own structure
-                flow_token=encrypted_flow_token,
+                flow_token=decrypted_payload.get("flow_token"),
             )
             return await self.process_response(
                 response_payload, aes_key, initial_vector
@@ -342,6 +314,7 @@ class FlowService:
         decrypted_payload: dict,
         aes_key: bytes,
         initial_vector: str,
+        claims: FlowTokenClaims,
         background_tasks: BackgroundTasks,
     ) -> PlainTextResponse:
         try:
@@ -353,10 +326,7 @@ class FlowService:
             selected_subjects = data.get("selected_subjects", [])
             self.logger.info("Selected subjects: %s", selected_subjects)
 
-            # Use helper functions for token and user validation
-            encrypted_flow_token = decrypted_payload.get("flow_token")
-            wa_id, flow_id = handle_token_validation(self.logger, encrypted_flow_token)
-            user = await validate_user(self.logger, wa_id)
+            user = await validate_user(self.logger, claims.wa_id)
 
             if not selected_subjects:
                 self.logger.error("No subjects selected")
@@ -376,7 +346,9 @@ class FlowService:
             self.logger.info("CREATED BACKGROUND TASK FOR SUBJECT DATA UPDATE")
 
             response_payload = create_flow_response_payload(
-                screen="SUCCESS", data={}, flow_token=encrypted_flow_token
+                screen="SUCCESS",
+                data={},
+                flow_token=decrypted_payload.get("flow_token"),
             )
 
             self.logger.info(
@@ -485,28 +457,21 @@ class FlowService:
         return JSONResponse(content={"flow_token": encrypted_flow_token})
 
     async def process_response(
-        self, response_payload: dict, aes_key: bytes, initial_vector: str
+        self, response_payload: dict | bytes, aes_key: bytes, initial_vector: str
     ) -> PlainTextResponse:
+        """Encrypt a response payload, which may already be serialized JSON (bytes)."""
         self.logger.info(
             f"Processing response: {response_payload} , AES Key: {aes_key} , IV: {initial_vector}"
         )
 
         try:
-            response_bytes = json.dumps(response_payload).encode("utf-8")
-
-            iv_bytes = base64.b64decode(initial_vector)
-            inverted_iv_bytes = bytes(~b & 0xFF for b in iv_bytes)
-
-            encryptor = Cipher(
-                algorithms.AES(aes_key),
-                modes.GCM(inverted_iv_bytes),
-                backend=default_backend(),
-            ).encryptor()
-            encrypted_data = encryptor.update(response_bytes) + encryptor.finalize()
-            encrypted_data_tag = encryptor.tag
-            encrypted_data_bytes = encrypted_data + encrypted_data_tag
-
-            encrypted_response = base64.b64encode(encrypted_data_bytes).decode("utf-8")
+            if isinstance(response_payload, bytes):
+                response_bytes = response_payload
+            else:
+                response_bytes = json.dumps(response_payload).encode("utf-8")
+            encrypted_response = flow_crypto.encrypt_response(
+                response_bytes, aes_key, initial_vector
+            )
             self.logger.info(f"Encrypted response: {encrypted_response}")
 
             return PlainTextResponse(content=encrypted_response, status_code=200)
@@ -517,7 +482,6 @@ class FlowService:
     async def send_personal_and_school_info_flow(
         self, user: User, is_update: bool = False
     ) -> None:
-        encrypt_flow_token(user.wa_id, settings.onboarding_flow_id)
         header_text = get_flow_text(
             is_update,
             "Update your personal and school information 📝",
@@ -565,18 +529,13 @@ class FlowService:
     async def send_select_subject_flow(
         self, user: User, is_update: bool = False
     ) -> None:
-        encrypt_flow_token(user.wa_id, settings.select_subjects_flow_id)
         logger.debug(f"Sending select subject flow to {user}")
 
         # Get available subjects from the database
-        subjects = await get_available_subjects()
+        subjects = await catalog.get_available_subjects()
 
         logger.debug(f"Available subjects: {subjects}")
 
-        select_subject_text = "This helps us find the best answers for your questions."
-        no_subjects_text = "Sorry, currently there are no active subjects."
-        has_subjects = len(subjects) > 0
-
         header_text = get_flow_text(
             is_update,
             "Update your class and subject selection 📝",
@@ -589,17 +548,7 @@ class FlowService:
         )
 
         response_payload = create_flow_response_payload(
-            screen="select_subjects",
-            data={
-                "subjects": (
-                    subjects
-                    if has_subjects
-                    else [{"id": "0", "title": "No subjects available"}]
-                ),  # doing this because the response in whatsapp flows expects a list of subjects with id and title
-                "has_subjects": has_subjects,
-                "no_subjects_text": no_subjects_text,
-                "select_subject_text": select_subject_text,
-            },
+            screen="select_subjects", data=create_select_subjects_payload(subjects)
         )
 
         await send_whatsapp_flow_message(
@@ -616,13 +565,12 @@ class FlowService:
     async def send_select_classes_flow(
         self, user: User, subject_id: int, is_update: bool = False
     ) -> None:
-        encrypt_flow_token(user.wa_id, settings.select_classes_flow_id)
         logger.debug(
             f"Sending select classes flow to {user} for subject ID {subject_id}"
         )
 
         # Get the subject title and classes for the given subject_id from the database
-        subject_data = await get_subject_and_classes(subject_id)
+        subject_data = await catalog.get_subject_and_classes(subject_id)
         subject_title = subject_data["subject_name"]
         classes = subject_data["classes"]
         logger.debug(f"Subject title for subject ID {subject_id}: {subject_title}")
@@ -1,66 +1,126 @@
 import json
 import logging
 import asyncio
-from typing import List, Optional
+from typing import Awaitable, List, Optional, TypeVar
 from openai.types.chat import ChatCompletionMessageToolCall
 
 from app.database.models import Message, User
 from app.database.enums import MessageRole
 from app.config import llm_settings
-from app.database.db import get_user_message_history
+from app.database.db import (
+    get_unsummarized_messages,
+    get_user_message_history,
+    retrieved_chunk_ids,
+)
 from app.utils.llm_utils import async_llm_request
+from app.utils.context_builder import context_builder
 from app.utils.prompt_manager import prompt_manager
 from app.tools.registry import tools_functions, tools_metadata
+from app.services.coordination_service import message_coordinator
+from app.services.response_cache_service import response_cache
+from app.services.persistence_service import message_writer
 
+T = TypeVar("T")
 
-class MessageProcessor:
-    """Handles processing and batching of messages for a single user."""
+# Recent messages in the prompt, all messages since the summary if it doesn't reach back to
+# it (at most MAX_UNSUMMARIZED_MESSAGES of them, the token budget still applies)
+HISTORY_WINDOW = 10
+MAX_UNSUMMARIZED_MESSAGES = 100
 
-    def __init__(self, user_id: int):
-        self.user_id = user_id
-        self.lock = asyncio.Lock()
-        self.messages: List[Message] = []
 
-    def add_message(self, message: Message) -> None:
-        self.messages.append(message)
-
-    def get_pending_messages(self) -> List[Message]:
-        return self.messages.copy()
-
-    def clear_messages(self) -> None:
-        self.messages.clear()
-
-    @property
-    def has_messages(self) -> bool:
-        return bool(self.messages)
+class LLMClient:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.coordinator = message_coordinator
+        # LLM requests whose result was sent, thrown away or cancelled (new messages arrived)
+        self.generation_stats = {"useful": 0, "wasted": 0, "cancelled": 0}
 
     @property
-    def is_locked(self) -> bool:
-        return self.lock.locked()
+    def stats(self) -> dict:
+        total = self.generation_stats["useful"] + self.generation_stats["wasted"]
+        return {
+            **self.generation_stats,
+            "waste_rate": round(
+                self.generation_stats["wasted"] / total if total else 0.0, 3
+            ),
+        }
+
+    async def _unless_new_messages(
+        self, user_id: int, known_count: int, awaitable: Awaitable[T]
+    ) -> Optional[T]:
+        """
+        Run an LLM request (or tool calls) as a task that is cancelled as soon as the user
+        sends a new message, since its result would be thrown away. Returns None then.
+        """
+        task = asyncio.ensure_future(awaitable)
+        watcher = asyncio.create_task(
+            self.coordinator.wait_for_new_messages(user_id, known_count)
+        )
+        try:
+            await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done() and watcher.exception() is None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return None
+            if not task.done():
+                # Could not watch for new messages, fall back to checking afterwards
+                self.logger.error(
+                    f"Failed to watch for new messages: {watcher.exception()}"
+                )
+            return await task
+        finally:
+            for pending in (task, watcher):
+                if not pending.done():
+                    pending.cancel()
+            await asyncio.gather(task, watcher, return_exceptions=True)
+
+    def _record_generations(self, count: int, wasted: bool) -> None:
+        self.generation_stats["wasted" if wasted else "useful"] += count
+        if wasted:
+            self.logger.warning(
+                f"Discarded {count} LLM generations, generation stats: {self.stats}"
+            )
 
+    async def _wait_for_quiet(self, user_id: int) -> None:
+        """
+        Wait until the user pauses, so a burst of short messages is answered by one
+        generation. Waits at most debounce_max_wait_ms in total.
+        """
+        quiet = llm_settings.debounce_quiet_ms / 1000
+        if quiet <= 0:
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + llm_settings.debounce_max_wait_ms / 1000
+        count = await self.coordinator.pending_count(user_id)
+        while (remaining := deadline - loop.time()) > 0:
+            new_count = await self.coordinator.wait_for_new_messages(
+                user_id, count, min(quiet, remaining)
+            )
+            if new_count <= count:
+                return
+            count = new_count
 
-class LLMClient:
-    def __init__(self):
-        self.logger = logging.getLogger(__name__)
-        self._processors: dict[int, MessageProcessor] = {}
-
-    def _get_processor(self, user_id: int) -> MessageProcessor:
-        """Get or create a message processor for a user."""
-        if user_id not in self._processors:
-            self._processors[user_id] = MessageProcessor(user_id)
-        return self._processors[user_id]
-
-    def _cleanup_processor(self, user_id: int) -> None:
-        """Remove processor if it's empty and unlocked."""
-        processor = self._processors.get(user_id)
-        if processor and not processor.has_messages and not processor.is_locked:
-            del self._processors[user_id]
-
-    def _check_new_messages(
-        self, processor: MessageProcessor, original_count: int
-    ) -> bool:
-        """Check if new messages arrived during processing."""
-        return len(processor.messages) > original_count
+    async def _get_history(self, user: User) -> Optional[List[Message]]:
+        """
+        Get the messages for the prompt. Messages between the summary and the history
+        window would be in neither, e.g. during a burst or while the summary is being
+        updated, so then everything since the summary is returned.
+        """
+        history = await get_user_message_history(user.id, limit=HISTORY_WINDOW)
+        if (
+            not llm_settings.conversation_summary_enabled
+            or not history
+            or len(history) < HISTORY_WINDOW
+            or any(message.id == user.summary_message_id for message in history)
+        ):
+            return history
+        return await get_unsummarized_messages(
+            user.id,
+            user.summary_message_id,
+            limit=MAX_UNSUMMARIZED_MESSAGES,
+            latest=True,
+        )
 
     async def _process_tool_calls(
         self,
@@ -71,180 +131,279 @@ class LLMClient:
         """Process tool calls and return just the new tool response messages."""
         if not resources:
             self.logger.error("No resources available for tool calls")
+            # Every tool call still needs a matching tool message in the conversation
             return [
                 Message(
                     user_id=user.id,
-                    role=MessageRole.system,
+                    role=MessageRole.tool,
                     content=json.dumps(
                         {
                             "error": "Tools are not available right now, no available resources."
                         }
                     ),
+                    tool_call_id=tool_call.id,
                 )
+                for tool_call in tool_calls
             ]
 
-        tool_responses = []
-        for tool_call in tool_calls:
-            try:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                # TODO: Make this more modular, depending on the need for each tool
-                function_args["user"] = user
-                function_args["resources"] = resources
-
-                if function_name in tools_functions:
-                    tool_func = tools_functions[function_name]
-                    result = (
-                        await tool_func(**function_args)
-                        if asyncio.iscoroutinefunction(tool_func)
-                        else tool_func(**function_args)
-                    )
-
-                    tool_responses.append(
-                        Message(
-                            user_id=user.id,
-                            role=MessageRole.tool,
-                            content=json.dumps(result),
-                            tool_call_id=tool_call.id,
-                        )
-                    )
-            except Exception as e:
-                self.logger.error(f"Error in {function_name}: {str(e)}")
-                tool_responses.append(
-                    Message(
-                        user_id=user.id,
-                        role=MessageRole.tool,
-                        content=json.dumps({"error": str(e)}),
-                        tool_call_id=tool_call.id,
-                    )
+        # Run every tool call of the turn concurrently, answers keep the original order
+        semaphore = asyncio.Semaphore(llm_settings.max_concurrent_tool_calls)
+        return list(
+            await asyncio.gather(
+                *(
+                    self._run_tool_call(tool_call, user, resources, semaphore)
+                    for tool_call in tool_calls
                 )
+            )
+        )
 
-            return tool_responses
+    async def _run_tool_call(
+        self,
+        tool_call: ChatCompletionMessageToolCall,
+        user: User,
+        resources: List[int],
+        semaphore: asyncio.Semaphore,
+    ) -> Message:
+        """Run a single tool call and wrap its result (or error) in a tool message."""
+        function_name = tool_call.function.name
+        try:
+            if function_name not in tools_functions:
+                raise Exception(f"Unknown tool: {function_name}")
+
+            function_args = json.loads(tool_call.function.arguments)
+            # TODO: Make this more modular, depending on the need for each tool
+            function_args["user"] = user
+            function_args["resources"] = resources
+
+            tool_func = tools_functions[function_name]
+            async with semaphore:
+                result = await asyncio.wait_for(
+                    (
+                        tool_func(**function_args)
+                        if asyncio.iscoroutinefunction(tool_func)
+                        else asyncio.to_thread(tool_func, **function_args)
+                    ),
+                    timeout=llm_settings.tool_timeout_s,
+                )
+            content = json.dumps(result)
+        except asyncio.TimeoutError:
+            self.logger.error(
+                f"{function_name} timed out after {llm_settings.tool_timeout_s}s"
+            )
+            content = json.dumps({"error": f"{function_name} timed out"})
+        except Exception as e:
+            self.logger.error(f"Error in {function_name}: {str(e)}")
+            content = json.dumps({"error": str(e)})
+
+        return Message(
+            user_id=user.id,
+            role=MessageRole.tool,
+            content=content,
+            tool_call_id=tool_call.id,
+        )
 
     async def generate_response(
         self,
         user: User,
         message: Message,
         resources: Optional[List[int]] = None,
+        raise_errors: bool = False,
     ) -> Optional[List[Message]]:
-        """Generate a response, handling message batching and tool calls."""
-        processor = self._get_processor(user.id)
-        processor.add_message(message)
-
-        self.logger.debug(
-            f"Message buffer for user: {user.wa_id}, buffer: {processor.get_pending_messages()}"
-        )
-
-        if processor.is_locked:
+        """
+        Generate a response, handling message batching and tool calls. Returns [] if the
+        message was buffered, the turn that is already running answers it. Errors return
+        None unless raise_errors is set, e.g. so a queued event can be tried again.
+        """
+        if not await self.coordinator.enqueue(user.id, message):
             self.logger.info(f"Lock held for user {user.wa_id}, message buffered")
-            return None
+            return []
 
-        async with processor.lock:
+        try:
             while True:
-                try:
-                    messages_to_process = processor.get_pending_messages()
-                    original_count = len(messages_to_process)
-                    if not messages_to_process:
-                        self.logger.warning(f"No messages to process for {user.wa_id}.")
-                        processor.clear_messages()
-                        self._cleanup_processor(user.id)
-                        return None
-
-                    # Get message history and format for the api
-                    history = await get_user_message_history(user.id)
-                    api_messages = self._format_messages(
-                        messages_to_process, history, user
+                await self._wait_for_quiet(user.id)
+                messages_to_process = await self.coordinator.get_pending(user.id)
+                self.logger.debug(
+                    f"Message buffer for user: {user.wa_id}, buffer: {messages_to_process}"
+                )
+                original_count = len(messages_to_process)
+                if not messages_to_process:
+                    self.logger.warning(f"No messages to process for {user.wa_id}.")
+                    await self.coordinator.abort(user.id)
+                    return None
+
+                # Get message history and format for the api (the previous turn may
+                # still be being stored)
+                await message_writer.wait_flushed(user.id)
+                history = await self._get_history(user)
+
+                # First-turn questions may have been answered for another teacher already
+                cacheable = response_cache.is_cacheable(
+                    messages_to_process, history, resources
+                )
+                if cacheable:
+                    cached_answer = await response_cache.lookup(
+                        messages_to_process[0].content, resources
                     )
-                    self.logger.debug(f"Initial messages:\n {api_messages}")
+                    if cached_answer is not None:
+                        if not await self.coordinator.try_release(
+                            user.id, messages_to_process
+                        ):
+                            continue
+                        return [
+                            Message(
+                                user_id=user.id,
+                                role=MessageRole.assistant,
+                                content=cached_answer,
+                            )
+                        ]
+                # Collects the ids of the chunks the tools retrieve
+                chunk_ids: List[int] = []
+                retrieved_chunk_ids.set(chunk_ids)
+
+                # Answers that may be reused for other teachers aren't personalized
+                api_messages = self._format_messages(
+                    messages_to_process, history, user, personalized=not cacheable
+                )
+                self.logger.debug(f"Initial messages:\n {api_messages}")
 
-                    # Initial response with tools
-                    initial_response = await async_llm_request(
+                # Initial response with tools
+                initial_response = await self._unless_new_messages(
+                    user.id,
+                    original_count,
+                    async_llm_request(
                         model=llm_settings.llm_model_name,
                         messages=api_messages,
                         tools=tools_metadata,
                         tool_choice="auto",
-                    )
-                    initial_message = Message.from_api_format(
-                        initial_response.choices[0].message.model_dump(), user.id
-                    )
-                    self.logger.debug(f"LLM response:\n {initial_message}")
-
-                    # Track new messages
-                    new_messages = [initial_message]
-
-                    # Check for new messages
-                    if self._check_new_messages(processor, original_count):
-                        self.logger.warning("New messages buffered during processing")
-                        continue
-
-                    # Process tool calls if present
-                    if initial_message.tool_calls:
-                        self.logger.debug("Processing tool calls 🛠️")
-
-                        # Process tool calls and track the tool response messages
-                        tool_responses = await self._process_tool_calls(
+                    ),
+                )
+                if initial_response is None:
+                    self.logger.warning("New messages buffered, cancelled generation")
+                    self.generation_stats["cancelled"] += 1
+                    continue
+                initial_message = Message.from_api_format(
+                    initial_response.choices[0].message.model_dump(), user.id
+                )
+                self.logger.debug(f"LLM response:\n {initial_message}")
+
+                # Track new messages
+                new_messages = [initial_message]
+                generations = 1
+
+                # Check for new messages
+                if await self.coordinator.has_new_messages(user.id, original_count):
+                    self.logger.warning("New messages buffered during processing")
+                    self._record_generations(generations, wasted=True)
+                    continue
+
+                # Process tool calls if present
+                if initial_message.tool_calls:
+                    self.logger.debug("Processing tool calls 🛠️")
+
+                    # Process tool calls and track the tool response messages
+                    tool_responses = await self._unless_new_messages(
+                        user.id,
+                        original_count,
+                        self._process_tool_calls(
                             initial_response.choices[0].message.tool_calls,
                             user,
                             resources,
-                        )
+                        ),
+                    )
+                    if tool_responses is None:
+                        self.logger.warning("New messages buffered, cancelled tools")
+                        self._record_generations(generations, wasted=True)
+                        continue
 
-                        if tool_responses:
-                            new_messages.extend(tool_responses)
+                    if tool_responses:
+                        new_messages.extend(tool_responses)
 
-                            # Update api_messages with new messages while preserving order
-                            api_messages.extend(
-                                msg.to_api_format() for msg in new_messages
-                            )
+                        # Update api_messages with new messages while preserving order
+                        api_messages.extend(msg.to_api_format() for msg in new_messages)
 
-                            # Get final response after tool calls
-                            final_response = await async_llm_request(
+                        # Get final response after tool calls
+                        final_response = await self._unless_new_messages(
+                            user.id,
+                            original_count,
+                            async_llm_request(
                                 model=llm_settings.llm_model_name,
                                 messages=api_messages,
                                 tools=None,
                                 tool_choice=None,
+                            ),
+                        )
+                        if final_response is None:
+                            self.logger.warning(
+                                "New messages buffered, cancelled final generation"
                             )
+                            self.generation_stats["cancelled"] += 1
+                            self._record_generations(generations, wasted=True)
+                            continue
 
-                            final_message = Message.from_api_format(
-                                final_response.choices[0].message.model_dump(), user.id
-                            )
-                            new_messages.append(final_message)
+                        final_message = Message.from_api_format(
+                            final_response.choices[0].message.model_dump(), user.id
+                        )
+                        new_messages.append(final_message)
+                        generations += 1
 
-                        # Check for new messages again
-                        if self._check_new_messages(processor, original_count):
-                            self.logger.warning("New messages buffered during tools")
-                            continue
+                    # Check for new messages again
+                    if await self.coordinator.has_new_messages(user.id, original_count):
+                        self.logger.warning("New messages buffered during tools")
+                        self._record_generations(generations, wasted=True)
+                        continue
 
-                    # Success - clear buffer and return response
-                    self.logger.debug("LLM finished. Clearing buffer.")
-                    processor.clear_messages()
-                    self._cleanup_processor(user.id)
-                    return new_messages
-                except Exception as e:
-                    self.logger.error(f"Error processing messages: {e}")
-                    processor.clear_messages()
-                    self._cleanup_processor(user.id)
-                    return None
+                # Success - clear buffer and return response, unless a message slipped in
+                if not await self.coordinator.try_release(user.id, messages_to_process):
+                    self.logger.warning("New messages buffered before release")
+                    self._record_generations(generations, wasted=True)
+                    continue
+                self._record_generations(generations, wasted=False)
+                self.logger.debug("LLM finished. Cleared buffer.")
+
+                # Only answers grounded in retrieved course content are worth reusing
+                if cacheable and chunk_ids and new_messages[-1].content:
+                    response_cache.store(
+                        messages_to_process[0].content,
+                        resources,
+                        new_messages[-1].content,
+                        chunk_ids,
+                    )
+                return new_messages
+        except Exception as e:
+            self.logger.error(f"Error processing messages: {e}")
+            await self.coordinator.abort(user.id)
+            if raise_errors:
+                raise
+            return None
 
-    @staticmethod
     def _format_messages(
+        self,
         new_messages: List[Message],
         database_messages: List[Message],
         user: User,
+        personalized: bool = True,
     ) -> List[dict]:
         """
-        Format messages for the API, removing duplicates between new messages and database history.
+        Format messages for the API, removing duplicates between new messages and database history,
+        and pack them into the token budget of the model. Unless personalized, the system prompt
+        leaves out the user's name, classes and conversation summary.
         """
-        # Initialize with system prompt
-        formatted_messages = [
-            {
-                "role": MessageRole.system,
-                "content": prompt_manager.format_prompt(
-                    "twiga_system", user_name=user.name, class_info=user.class_info
-                ),
-            }
-        ]
+        if not personalized:
+            system_prompt = prompt_manager.format_prompt(
+                "twiga_system",
+                user_name="a teacher",
+                class_info="secondary school classes",
+            )
+        else:
+            system_prompt = prompt_manager.format_prompt(
+                "twiga_system", user_name=user.name, class_info=user.class_info
+            )
+        if personalized and user.conversation_summary:
+            system_prompt += f"\n\nSummary of your earlier conversation with {user.name}:\n{user.conversation_summary}"
+        system_message = {"role": MessageRole.system, "content": system_prompt}
 
         # Add history messages
+        old_messages = []
         if database_messages:
             # Exclude potential duplicates
             message_count = len(new_messages)
@@ -261,10 +420,28 @@ class LLMClient:
                 if message_count > 0
                 else database_messages
             )
-            formatted_messages.extend(msg.to_api_format() for msg in old_messages)
-
-        # Add new messages
-        formatted_messages.extend(msg.to_api_format() for msg in new_messages)
+            # Turns that are already part of the summary are replaced by it (the history
+            # is in conversation order, which isn't always id order)
+            summarized = next(
+                (
+                    index
+                    for index, msg in enumerate(old_messages)
+                    if msg.id == user.summary_message_id
+                ),
+                None,
+            )
+            if summarized is not None:
+                old_messages = old_messages[summarized + 1 :]
+
+        formatted_messages, token_count = context_builder.build(
+            system_message,
+            old_messages,
+            new_messages,
+            model=llm_settings.llm_model_name,
+        )
+        self.logger.info(
+            f"Packed {len(formatted_messages)} messages ({token_count} tokens) for {user.wa_id}"
+        )
 
         return formatted_messages
 
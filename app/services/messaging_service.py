@@ -1,5 +1,6 @@
 import json
 import logging
+from typing import Awaitable, Callable, List, Optional
 from fastapi import Request
 from fastapi.responses import JSONResponse
 
@@ -8,7 +9,6 @@ from app.database.models import (
     User,
     UserState,
 )
-from app.database.enums import MessageRole
 from app.utils.whatsapp_utils import (
     RequestType,
     ValidMessageType,
@@ -21,6 +21,10 @@ from app.services.whatsapp_service import whatsapp_client
 from app.services.llm_service import llm_client
 from app.services.flow_service import flow_client
 from app.services.state_service import state_client
+from app.services.queue_service import QueueFullError, inbound_queue
+from app.services.dedup_service import message_deduplicator
+from app.services.summary_service import conversation_summarizer
+from app.services.persistence_service import message_writer
 import app.database.db as db
 from app.config import settings
 from app.utils.string_manager import strings, StringCategory
@@ -51,6 +55,14 @@ async def handle_request(request: Request) -> JSONResponse:
             case RequestType.OUTDATED:
                 return whatsapp_client.handle_outdated_message(body)
             case RequestType.VALID_MESSAGE:
+                message_id = extract_message_info(body).get("message_id")
+                if message_deduplicator.is_duplicate(message_id):
+                    return JSONResponse(
+                        content={"status": "ok", "message": "Duplicate message"},
+                        status_code=200,
+                    )
+                if settings.message_queue_enabled:
+                    return await enqueue_valid_message(body)
                 return await handle_valid_message(body)
 
         raise Exception(f"Invalid request type. This is the request body: {body}")
@@ -68,18 +80,60 @@ async def handle_request(request: Request) -> JSONResponse:
         )
 
 
-async def handle_valid_message(body: dict) -> JSONResponse:
-    # Extract message information and create/get user
+async def enqueue_valid_message(body: dict) -> JSONResponse:
+    """
+    Stores the message on the inbound queue and acknowledges it right away, the queue
+    workers then run handle_valid_message in the background.
+    """
     message_info = extract_message_info(body)
-    message = extract_message(message_info.get("message", {}))
-    user = await db.get_or_create_user(
-        wa_id=message_info.get("wa_id"), name=message_info.get("name")
+    try:
+        await inbound_queue.put(message_info.get("wa_id"), body)
+    except QueueFullError as e:
+        # WhatsApp delivers the message again later
+        logger.warning(str(e))
+        return JSONResponse(
+            content={"status": "error", "message": "Too many queued messages"},
+            status_code=503,
+        )
+    # Retries that arrive while the event is still queued are dropped right away
+    message_deduplicator.mark_seen(message_info.get("message_id"))
+    return JSONResponse(
+        content={"status": "ok"},
+        status_code=200,
     )
 
-    # Create message record
-    user_message = await db.create_new_message(
-        Message(user_id=user.id, role=MessageRole.user, content=message)
+
+async def handle_valid_message(
+    body: dict,
+    attempt: Optional[int] = None,
+    on_stored: Optional[Callable[[], Awaitable[None]]] = None,
+) -> JSONResponse:
+    """
+    Handles a valid message, either inline in the webhook or from the inbound queue, in
+    which case attempt is the queue's attempt number and on_stored is awaited before a
+    chat turn starts, so the queue can move on to the user's next message.
+    """
+    # Extract message information and create/get user
+    message_info = extract_message_info(body)
+    message = extract_message(message_info.get("message", {}))
+    message_id = message_info.get("message_id")
+
+    # Store the user and message in one transaction (a redelivered message isn't stored,
+    # but a retried event continues with the message its failed attempt stored)
+    user, user_message, resources = await db.ingest_user_message(
+        wa_id=message_info.get("wa_id"),
+        content=message,
+        wa_message_id=message_id,
+        name=message_info.get("name"),
+        reprocess=attempt is not None and attempt > 1,
     )
+    if user_message is None:
+        message_deduplicator.record_database_hit(message_id)
+        return JSONResponse(
+            content={"status": "ok", "message": "Duplicate message"},
+            status_code=200,
+        )
+    message_deduplicator.mark_seen(message_id)
 
     logger.debug(f"Processing message for user {user.wa_id} in state {user.state}")
 
@@ -106,7 +160,14 @@ async def handle_valid_message(body: dict) -> JSONResponse:
                 case ValidMessageType.COMMAND:
                     return await handle_command_message(user, user_message)
                 case ValidMessageType.CHAT:
-                    return await handle_chat_message(user, user_message)
+                    retry_on_error = attempt is not None and inbound_queue.will_retry(
+                        attempt
+                    )
+                    if on_stored is not None:
+                        await on_stored()
+                    return await handle_chat_message(
+                        user, user_message, resources, retry_on_error
+                    )
 
     raise Exception("Invalid user state, reached the end of handle_valid_message")
 
@@ -148,20 +209,38 @@ async def handle_command_message(user: User, message: Message) -> JSONResponse:
     )
 
 
-async def handle_chat_message(user: User, user_message: Message) -> JSONResponse:
-    available_user_resources = await db.get_user_resources(user)
+async def handle_chat_message(
+    user: User,
+    user_message: Message,
+    resources: Optional[List[int]] = None,
+    retry_on_error: bool = False,
+) -> JSONResponse:
+    # The ingest already looked up the resources of active users ([] if they have none)
+    available_user_resources = (
+        await db.get_user_resources(user) if resources is None else resources or None
+    )
+    # When the queue will try the event again, fail it instead of sending the error reply
     llm_responses = await llm_client.generate_response(
-        user=user, message=user_message, resources=available_user_resources
+        user=user,
+        message=user_message,
+        resources=available_user_resources,
+        raise_errors=retry_on_error,
     )
     if llm_responses:
         logger.debug(f"Sending message to {user.wa_id}: {llm_responses[-1].content}")
 
-        # Update the database with the responses
-        llm_responses = await db.create_new_messages(llm_responses)
-
-        # Send the last message back to the user
-        await whatsapp_client.send_message(user.wa_id, llm_responses[-1].content)
-    else:
+        if settings.message_write_behind_enabled:
+            # The messages are stored in the background while the reply is sent. They
+            # are submitted first, so the user's next turn waits for them (wait_flushed)
+            await message_writer.submit(llm_responses)
+            await whatsapp_client.send_message(user.wa_id, llm_responses[-1].content)
+        else:
+            llm_responses = await message_writer.write(llm_responses)
+            await whatsapp_client.send_message(user.wa_id, llm_responses[-1].content)
+
+        # Fold older turns into the running summary without delaying the reply
+        conversation_summarizer.schedule(user)
+    elif llm_responses is None:
         logger.error("No responses generated by LLM")
         err_message = strings.get_string(StringCategory.ERROR, "general")
         await whatsapp_client.send_message(user.wa_id, err_message)
@@ -0,0 +1,204 @@
+"""
+This module stores the assistant and tool messages of LLM turns. Each turn only stores a
+few messages, but many turns finish at the same time under load, so the messages stored
+within a short window are coalesced into a single INSERT ... RETURNING statement.
+
+With write-behind, a turn's messages are stored in the background while its reply is
+sent, so the user's next message can be stored before them. Anything that reads a user's
+history has to call wait_flushed first, so it never misses the messages of the previous
+turn, and has to order it by (created_at, id) rather than by id.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.config import settings
+from app.database.models import Message
+import app.database.db as db
+
+# Write-behind retries a failed write with exponential backoff before dropping it
+WRITE_BEHIND_ATTEMPTS = 3
+WRITE_BEHIND_RETRY_DELAY_S = 0.5
+
+BatchInserter = Callable[[List[Message]], Awaitable[List[Message]]]
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        coalesce_ms: int,
+        max_batch: int,
+        max_pending: int,
+        insert_batch: BatchInserter = db.create_new_messages,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.coalesce_s = coalesce_ms / 1000
+        self.max_batch = max_batch
+        self.insert_batch = insert_batch
+        self.statements = 0
+        self.rows = 0
+        # The messages of each waiting write and the future its caller awaits
+        self._batch: List[Tuple[List[Message], asyncio.Future]] = []
+        self._batch_rows = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+        # Write-behind: the slots bound how many turns may wait to be stored
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending: Dict[int, Set[asyncio.Task]] = {}
+
+    async def write(self, messages: List[Message]) -> List[Message]:
+        """Store messages (in order) and return them once their ids are set."""
+        if not messages:
+            return []
+        if self.coalesce_s <= 0:
+            return await self._insert(messages)
+
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((messages, future))
+        self._batch_rows += len(messages)
+        if self._batch_rows >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after_window())
+        return await future
+
+    async def _flush_after_window(self) -> None:
+        await asyncio.sleep(self.coalesce_s)
+        self._timer = None
+        self._start_flush()
+
+    def _start_flush(self) -> None:
+        task = asyncio.create_task(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self) -> None:
+        batch, self._batch, self._batch_rows = self._batch, [], 0
+        if not batch:
+            return
+
+        try:
+            await self._insert(
+                [message for messages, _ in batch for message in messages]
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch[0][1], error=e)
+                return
+            # Retry the writes one by one so a bad message only fails its own turn
+            self.logger.warning(f"Coalesced message write failed, retrying: {e}")
+            for messages, future in batch:
+                try:
+                    await self._insert(messages)
+                except Exception as write_error:
+                    self._resolve(future, error=write_error)
+                else:
+                    self._resolve(future, messages)
+            return
+
+        for messages, future in batch:
+            self._resolve(future, messages)
+
+    @staticmethod
+    def _resolve(
+        future: asyncio.Future,
+        messages: Optional[List[Message]] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        # The caller may have been cancelled, its messages are stored all the same
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(messages)
+
+    async def _insert(self, messages: List[Message]) -> List[Message]:
+        stored = await self.insert_batch(messages)
+        self.statements += 1
+        self.rows += len(messages)
+        return stored
+
+    async def submit(self, messages: List[Message]) -> None:
+        """
+        Store messages in the background. Only waits (backpressure) when too many turns
+        are already waiting to be stored, e.g. while the database is slow or down.
+        """
+        if not messages:
+            return
+        await self._slots.acquire()
+        user_id = messages[0].user_id
+        task = asyncio.create_task(self._write_behind(messages))
+        self._pending.setdefault(user_id, set()).add(task)
+        task.add_done_callback(lambda done: self._forget(user_id, done))
+
+    async def _write_behind(self, messages: List[Message]) -> None:
+        try:
+            for attempt in range(1, WRITE_BEHIND_ATTEMPTS + 1):
+                try:
+                    await self.write(messages)
+                    return
+                except Exception as e:
+                    if attempt == WRITE_BEHIND_ATTEMPTS:
+                        self.logger.error(
+                            f"Dropped {len(messages)} messages of user {messages[0].user_id}: {e}"
+                        )
+                        return
+                    self.logger.warning(
+                        f"Failed to store messages (attempt {attempt}), retrying: {e}"
+                    )
+                    await asyncio.sleep(WRITE_BEHIND_RETRY_DELAY_S * 2 ** (attempt - 1))
+        finally:
+            self._slots.release()
+
+    def _forget(self, user_id: int, task: asyncio.Task) -> None:
+        tasks = self._pending.get(user_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._pending[user_id]
+
+    async def wait_flushed(self, user_id: int) -> None:
+        """Wait until the messages submitted for a user are stored (or given up on)."""
+        tasks = self._pending.get(user_id)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def pending_writes(self) -> int:
+        return sum(len(tasks) for tasks in self._pending.values())
+
+    async def close(self) -> None:
+        """Store everything that was submitted, e.g. on shutdown."""
+        tasks = [task for tasks in self._pending.values() for task in tasks]
+        if tasks:
+            self.logger.info(f"Storing {len(tasks)} pending message writes")
+        await self.flush()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def flush(self) -> None:
+        """Store everything that is waiting for the coalescing window right away."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self._flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "statements": self.statements,
+            "rows": self.rows,
+            "pending_writes": self.pending_writes,
+            "rows_per_statement": round(
+                self.rows / self.statements if self.statements else 0.0, 2
+            ),
+        }
+
+
+message_writer = MessageWriter(
+    coalesce_ms=settings.message_write_coalesce_ms,
+    max_batch=settings.message_write_max_batch,
+    max_pending=settings.message_write_max_pending,
+)
@@ -0,0 +1,306 @@
+"""
+This module contains the inbound message queue used to acknowledge webhooks before the
+(slow) LLM pipeline runs. Events are sharded by wa_id onto a fixed pool of workers so
+messages from the same user are always stored in the order they arrived.
+
+A worker only waits for an event until its message is stored. Chat turns then run as
+tasks of their own, so a slow turn doesn't hold up other users on the same worker, and
+the user's next message is buffered and answered by the running turn (the coordinator).
+"""
+
+import asyncio
+import logging
+import zlib
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from app.config import settings
+import app.database.db as db
+
+# Called with the event payload, the attempt number (starting at 1) and a callback the
+# handler awaits once the event's message is stored and its turn may run concurrently
+EventHandler = Callable[[dict, int, Callable[[], Awaitable[None]]], Awaitable[object]]
+
+# (event id, wa_id, payload, attempts); the id is None for the memory backend
+QueuedEvent = Tuple[Optional[int], str, dict, int]
+
+
+class QueueFullError(Exception):
+    """Raised when an event can't be queued because its worker is too far behind."""
+
+
+class MemoryQueueBackend:
+    """
+    Keeps events in process memory. Fast and dependency free, but events that have not
+    been processed are lost if the process dies.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    async def put(self, wa_id: str, payload: dict) -> Optional[int]:
+        return None
+
+    async def claim(self, limit: int) -> List[QueuedEvent]:
+        return []
+
+    async def mark_running(self, event_id: Optional[int]) -> None:
+        pass
+
+    async def complete(self, event_id: Optional[int]) -> None:
+        pass
+
+    async def fail(self, event_id: Optional[int], error: str, retry: bool) -> None:
+        pass
+
+    async def release(self, event_ids: List[int]) -> None:
+        pass
+
+    @property
+    def is_durable(self) -> bool:
+        return False
+
+
+class PostgresQueueBackend:
+    """
+    Persists events to the inbound_events table. Any number of processes can drain the
+    table, and events survive restarts and crashes.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.wakeup = asyncio.Event()
+
+    async def put(self, wa_id: str, payload: dict) -> Optional[int]:
+        event_id = await db.enqueue_inbound_event(wa_id, payload)
+        # Let the local dispatcher pick the event up without waiting for the next poll
+        self.wakeup.set()
+        return event_id
+
+    async def claim(self, limit: int) -> List[QueuedEvent]:
+        events = await db.claim_inbound_events(
+            limit=limit,
+            visibility_timeout=settings.message_queue_visibility_timeout_s,
+            retry_delay=settings.message_queue_retry_delay_s,
+        )
+        return [
+            (event.id, event.wa_id, event.payload, event.attempts) for event in events
+        ]
+
+    async def mark_running(self, event_id: Optional[int]) -> None:
+        await db.mark_inbound_event_running(event_id)
+        # The user's next event (if any) has just become claimable
+        self.wakeup.set()
+
+    async def complete(self, event_id: Optional[int]) -> None:
+        await db.complete_inbound_event(event_id)
+        # The user's next event (if any) has just become claimable
+        self.wakeup.set()
+
+    async def fail(self, event_id: Optional[int], error: str, retry: bool) -> None:
+        await db.fail_inbound_event(event_id, error, retry)
+
+    async def release(self, event_ids: List[int]) -> None:
+        await db.release_inbound_events(event_ids)
+
+    @property
+    def is_durable(self) -> bool:
+        return True
+
+
+class InboundQueue:
+    def __init__(self, backend: str = settings.message_queue_backend):
+        self.logger = logging.getLogger(__name__)
+        self.backend = (
+            PostgresQueueBackend() if backend == "postgres" else MemoryQueueBackend()
+        )
+        self.num_workers = max(1, settings.message_queue_workers)
+        self.max_depth = max(1, settings.message_queue_max_depth)
+        self.shards: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        # The turns that run after their message was stored, and the slots that bound them
+        self._turns: Set[asyncio.Task] = set()
+        self._turn_slots = asyncio.Semaphore(max(1, settings.message_queue_max_running))
+        self._dispatcher_task: Optional[asyncio.Task] = None
+        self._handler: Optional[EventHandler] = None
+
+    def _shard_for(self, wa_id: str) -> asyncio.Queue:
+        """Events of one wa_id always land on the same worker, preserving their order."""
+        return self.shards[zlib.crc32(wa_id.encode("utf-8")) % len(self.shards)]
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    def will_retry(self, attempts: int) -> bool:
+        """Whether an event that fails on this attempt is tried again (postgres only)."""
+        return (
+            self.backend.is_durable and attempts < settings.message_queue_max_attempts
+        )
+
+    @property
+    def depth(self) -> int:
+        """Number of events waiting on the local workers."""
+        return sum(shard.qsize() for shard in self.shards)
+
+    @property
+    def running(self) -> int:
+        """Number of turns running after their message was stored."""
+        return len(self._turns)
+
+    async def start(self, handler: EventHandler) -> None:
+        if self.is_running:
+            return
+
+        self._handler = handler
+        self.shards = [
+            asyncio.Queue(maxsize=self.max_depth) for _ in range(self.num_workers)
+        ]
+        self._tasks = [
+            asyncio.create_task(self._worker(shard)) for shard in self.shards
+        ]
+        if self.backend.is_durable:
+            self._dispatcher_task = asyncio.create_task(self._dispatcher())
+
+        self.logger.info(
+            f"Started {self.num_workers} inbound queue workers ({type(self.backend).__name__})"
+        )
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        if not self.is_running:
+            return
+
+        # Stop claiming new events, then give the workers a chance to finish what is queued
+        if self._dispatcher_task:
+            self._dispatcher_task.cancel()
+            await asyncio.gather(self._dispatcher_task, return_exceptions=True)
+            self._dispatcher_task = None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(shard.join() for shard in self.shards)), timeout
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning(
+                f"Inbound queue did not drain within {timeout}s, {self.depth} events left"
+            )
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Turns that don't finish in time are cancelled, with postgres their events are
+        # claimed again after the visibility timeout
+        turns = list(self._turns)
+        if turns:
+            _, unfinished = await asyncio.wait(
+                turns, timeout=max(0.0, deadline - loop.time())
+            )
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*turns, return_exceptions=True)
+            if unfinished:
+                self.logger.warning(f"Cancelled {len(unfinished)} running turns")
+
+        # Hand anything still claimed back to the queue so another process can take it
+        leftover_ids = []
+        for shard in self.shards:
+            while not shard.empty():
+                event_id, *_ = shard.get_nowait()
+                if event_id is not None:
+                    leftover_ids.append(event_id)
+        if leftover_ids:
+            await self.backend.release(leftover_ids)
+
+        self.logger.info("Inbound queue workers stopped")
+
+    async def put(self, wa_id: str, payload: dict) -> None:
+        """
+        Queue a webhook event. Returns as soon as the event is stored, raises
+        QueueFullError if the event's worker already has max_depth events waiting.
+        """
+        # Postgres events wait in the table until their worker has room for them
+        if not self.backend.is_durable:
+            if not self.is_running:
+                raise Exception("Inbound queue is not running")
+            if self._shard_for(wa_id).full():
+                raise QueueFullError(f"No room in the inbound queue for {wa_id}")
+        event_id = await self.backend.put(wa_id, payload)
+        if not self.backend.is_durable:
+            self._shard_for(wa_id).put_nowait((event_id, wa_id, payload, 1))
+        self.logger.debug(f"Queued event for {wa_id}, local depth {self.depth}")
+
+    async def _dispatcher(self) -> None:
+        """Claim persisted events and hand them to the worker owning their wa_id."""
+        poll_interval = settings.message_queue_poll_interval_ms / 1000
+        while True:
+            try:
+                capacity = self.num_workers * self.max_depth - self.depth
+                events = await self.backend.claim(capacity) if capacity > 0 else []
+                overflow = []
+                for event in events:
+                    try:
+                        self._shard_for(event[1]).put_nowait(event)
+                    except asyncio.QueueFull:
+                        overflow.append(event[0])
+                # Events of a worker that is full are left to a later claim
+                if overflow:
+                    await self.backend.release(overflow)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Error claiming inbound events: {str(e)}")
+                events = []
+
+            if not events:
+                try:
+                    await asyncio.wait_for(self.backend.wakeup.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.backend.wakeup.clear()
+
+    async def _worker(self, shard: asyncio.Queue) -> None:
+        while True:
+            event = await shard.get()
+            try:
+                await self._turn_slots.acquire()
+                stored = asyncio.Event()
+                turn = asyncio.create_task(self._process(event, stored))
+                self._turns.add(turn)
+                turn.add_done_callback(self._turns.discard)
+                # Move on to the next event once this one's message is stored, the turn
+                # (and a later message of the same user) is then up to the coordinator
+                stored_wait = asyncio.create_task(stored.wait())
+                await asyncio.wait(
+                    {turn, stored_wait}, return_when=asyncio.FIRST_COMPLETED
+                )
+                stored_wait.cancel()
+            finally:
+                shard.task_done()
+
+    async def _process(self, event: QueuedEvent, stored: asyncio.Event) -> None:
+        event_id, wa_id, payload, attempts = event
+
+        async def on_stored() -> None:
+            await self.backend.mark_running(event_id)
+            stored.set()
+
+        try:
+            await self._handler(payload, attempts, on_stored)
+            await self.backend.complete(event_id)
+        except Exception as e:
+            retry = self.will_retry(attempts)
+            self.logger.error(
+                f"Error processing queued event for {wa_id} (attempt {attempts}): {str(e)}"
+            )
+            try:
+                await self.backend.fail(event_id, str(e), retry)
+            except Exception as e:
+                self.logger.error(f"Failed to record queue failure: {str(e)}")
+        finally:
+            self._turn_slots.release()
+
+
+inbound_queue = InboundQueue()
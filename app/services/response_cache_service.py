@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import List, Optional, Set
+
+from app.config import llm_settings
+from app.database.db import (
+    create_cached_response,
+    find_cached_response,
+    invalidate_cached_responses,
+)
+from app.database.enums import MessageRole
+from app.database.models import Message, ResponseCacheEntry
+from app.utils.embedder import embedding_client
+
+
+class ResponseCache:
+    """
+    Semantic cache of final answers to first-turn questions. Teachers of the same classes
+    ask near-identical questions, so an answer is reused when a new question on the same
+    set of resources has a close enough embedding. Only questions that don't depend on
+    the conversation before them are looked up or stored, and their answers are generated
+    without the teacher's name, classes or conversation summary.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self._write_tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def resource_key(resources: List[int]) -> str:
+        return ",".join(str(resource_id) for resource_id in sorted(set(resources)))
+
+    def is_cacheable(
+        self,
+        pending: List[Message],
+        history: Optional[List[Message]],
+        resources: Optional[List[int]],
+    ) -> bool:
+        """
+        A single question with no recent conversation before it (the first turn of a new
+        conversation), asked by a teacher with resources.
+        """
+        if not llm_settings.response_cache_enabled or not resources:
+            return False
+        if len(pending) != 1 or pending[0].role != MessageRole.user:
+            return False
+        if not pending[0].content:
+            return False
+
+        session_gap = timedelta(seconds=llm_settings.response_cache_session_gap_s)
+        asked_at = pending[0].created_at
+        return not any(
+            message.id != pending[0].id
+            and message.created_at is not None
+            and asked_at - message.created_at < session_gap
+            for message in history or []
+        )
+
+    async def lookup(self, question: str, resources: List[int]) -> Optional[str]:
+        try:
+            query_vector = await embedding_client.get_embedding(question)
+            entry = await find_cached_response(
+                self.resource_key(resources),
+                query_vector,
+                max_distance=llm_settings.response_cache_max_distance,
+                ttl=llm_settings.response_cache_ttl_s,
+            )
+        except Exception as e:
+            # The cache is an optimization, never fail the request because of it
+            self.logger.error(f"Failed to look up cached response: {e}")
+            return None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.logger.info(
+            f"Answered from the response cache (entry {entry.id}), hits={self.hits} misses={self.misses}"
+        )
+        return entry.answer
+
+    def store(
+        self, question: str, resources: List[int], answer: str, chunk_ids: List[int]
+    ) -> None:
+        """Store an answer in the background."""
+        task = asyncio.create_task(
+            self._store(question, resources, answer, sorted(set(chunk_ids)))
+        )
+        self._write_tasks.add(task)
+        task.add_done_callback(self._write_tasks.discard)
+
+    async def _store(
+        self, question: str, resources: List[int], answer: str, chunk_ids: List[int]
+    ) -> None:
+        try:
+            await create_cached_response(
+                ResponseCacheEntry(
+                    resource_key=self.resource_key(resources),
+                    resource_ids=sorted(set(resources)),
+                    query=question,
+                    embedding=await embedding_client.get_embedding(question),
+                    answer=answer,
+                    chunk_ids=chunk_ids,
+                )
+            )
+        except Exception as e:
+            self.logger.error(f"Failed to store cached response: {e}")
+
+    async def invalidate(self, resource_ids: List[int]) -> int:
+        """Drop the answers that drew on these resources, e.g. after their chunks changed."""
+        deleted = await invalidate_cached_responses(resource_ids)
+        self.logger.info(
+            f"Invalidated {deleted} cached responses for resources {resource_ids}"
+        )
+        return deleted
+
+
+response_cache = ResponseCache()
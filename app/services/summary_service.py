@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from app.config import llm_settings
+from app.database.db import get_unsummarized_messages, update_user_summary
+from app.database.enums import MessageRole
+from app.database.models import Message, User
+from app.services.persistence_service import message_writer
+from app.utils.llm_utils import async_llm_request, truncate_to_tokens
+from app.utils.prompt_manager import prompt_manager
+
+
+class ConversationSummarizer:
+    """
+    Keeps a running summary per user of the conversation before their most recent turns.
+    The summary is updated in the background after a reply has been sent and replaces the
+    older turns in the prompt, so the prompt stays the same size as a conversation grows.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, user: User) -> None:
+        """Update the summary of a user in the background (at most once at a time)."""
+        if not llm_settings.conversation_summary_enabled or user.id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(user))
+        self._tasks[user.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user.id, None))
+
+    async def _run(self, user: User) -> None:
+        try:
+            await self.update_summary(user)
+        except Exception as e:
+            self.logger.error(f"Failed to summarize conversation of {user.wa_id}: {e}")
+
+    async def update_summary(self, user: User) -> Optional[str]:
+        """
+        Fold the messages that precede the most recent ones into the user's summary, once
+        enough of them have accumulated. Returns the new summary, if one was made.
+        """
+        keep = llm_settings.summary_keep_recent_messages
+        min_new = llm_settings.summary_min_new_messages
+        await message_writer.wait_flushed(user.id)
+        messages = await get_unsummarized_messages(
+            user.id, user.summary_message_id, limit=keep + 4 * min_new
+        )
+
+        # Never separate an assistant tool call from its tool messages
+        boundary = len(messages) - keep
+        while (
+            0 <= boundary < len(messages)
+            and messages[boundary].role == MessageRole.tool
+        ):
+            boundary += 1
+        if boundary < min_new:
+            return None
+        to_fold = messages[:boundary]
+
+        prompt = prompt_manager.format_prompt(
+            "conversation_summarizer",
+            max_words=llm_settings.summary_max_words,
+            previous_summary=user.conversation_summary or "(none yet)",
+            conversation=self._format_transcript(to_fold),
+        )
+        response = await async_llm_request(
+            model=llm_settings.exercise_generator_model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=llm_settings.summary_max_words * 2,
+        )
+        summary = (response.choices[0].message.content or "").strip()
+        if not summary:
+            self.logger.warning(f"Empty conversation summary for {user.wa_id}")
+            return None
+
+        if not await update_user_summary(user.id, summary, to_fold[-1].id):
+            self.logger.info(f"Newer summary already stored for {user.wa_id}")
+            return None
+
+        user.conversation_summary = summary
+        user.summary_message_id = to_fold[-1].id
+        self.logger.info(
+            f"Folded {len(to_fold)} messages into the summary of {user.wa_id}"
+        )
+        return summary
+
+    @staticmethod
+    def _format_transcript(messages: List[Message]) -> str:
+        lines = []
+        for message in messages:
+            if message.tool_calls:
+                for tool_call in message.tool_calls:
+                    function = tool_call.get("function", {})
+                    lines.append(
+                        f"assistant (tool call): {function.get('name')}({function.get('arguments')})"
+                    )
+            if not message.content:
+                continue
+            if message.role == MessageRole.tool:
+                # Retrieved content is verbose, a short excerpt says what the tool returned
+                content = truncate_to_tokens(
+                    message.content, llm_settings.stale_tool_output_max_tokens
+                )
+                lines.append(f"tool result: {content}")
+            else:
+                lines.append(f"{message.role}: {message.content}")
+        return "\n".join(lines)
+
+    async def stop(self) -> None:
+        """Cancel summaries still running, e.g. on shutdown."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+conversation_summarizer = ConversationSummarizer()
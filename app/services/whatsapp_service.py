@@ -3,6 +3,7 @@ from fastapi import Request
 from fastapi.responses import PlainTextResponse, JSONResponse
 import logging
 
+import backoff
 import httpx
 
 from app.config import settings
@@ -10,7 +11,24 @@ from app.utils.logging_utils import log_httpx_response
 from app.utils.whatsapp_utils import generate_payload
 
 
+# Errors raised before the request reached the Graph API, so retrying can't send a
+# message twice (unlike e.g. a read timeout)
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def is_retryable_response(response: httpx.Response) -> bool:
+    # A 5xx (e.g. a 502 from a proxy) may come after the message was accepted and sent,
+    # only a rate limited send was certainly rejected
+    return response.status_code == 429
+
+
 class WhatsAppClient:
+    """
+    Sends messages through the Graph API. All sends (text and flow messages) share one
+    pooled HTTP/2 client, so they reuse the connections to graph.facebook.com instead of
+    paying for a TLS handshake each time.
+    """
+
     def __init__(self):
         self.headers = {
             "Content-type": "application/json",
@@ -18,22 +36,54 @@ class WhatsAppClient:
         }
         self.url = f"https://graph.facebook.com/{settings.meta_api_version}/{settings.whatsapp_cloud_number_id}"
         self.logger = logging.getLogger(__name__)
-        self.client = httpx.AsyncClient(base_url=self.url)
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            headers=self.headers,
+            http2=settings.whatsapp_http2,
+            limits=httpx.Limits(
+                max_connections=settings.whatsapp_max_connections,
+                max_keepalive_connections=settings.whatsapp_max_keepalive_connections,
+                keepalive_expiry=60.0,
+            ),
+            timeout=httpx.Timeout(settings.whatsapp_timeout_s, connect=5.0),
+        )
 
     async def send_message(
         self, wa_id: str, message: str, options: Optional[List[str]] = None
     ) -> None:
         try:
             payload = generate_payload(wa_id, message, options)
-            response = await self.client.post(
-                "/messages", data=payload, headers=self.headers
-            )
+            response = await self.post_message(payload)
             log_httpx_response(response)
         except httpx.RequestError as e:
             self.logger.error("Request Error: %s", e)
         except Exception as e:
             self.logger.error("Unexpected Error: %s", e)
 
+    @backoff.on_predicate(
+        backoff.expo,
+        is_retryable_response,
+        max_tries=lambda: settings.whatsapp_max_tries,
+        jitter=backoff.full_jitter,
+    )
+    @backoff.on_exception(
+        backoff.expo,
+        RETRYABLE_ERRORS,
+        max_tries=lambda: settings.whatsapp_max_tries,
+        jitter=backoff.full_jitter,
+    )
+    async def post_message(self, payload: str) -> httpx.Response:
+        """
+        Post a JSON message payload to the messages endpoint. Rate limited (429)
+        responses and connection errors are retried with jittered exponential backoff,
+        the last response is returned either way. Sends aren't idempotent, so other
+        errors aren't retried.
+        """
+        return await self.client.post("/messages", content=payload)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
     def verify(self, request: Request):
         """
         Verifies the webhook for WhatsApp. This is required.
@@ -3,7 +3,8 @@ from typing import List, Optional
 
 from app.utils.llm_utils import async_llm_request
 from app.utils.prompt_manager import prompt_manager
-from app.database.db import vector_search
+from app.database.db import vector_search_multi
+from app.utils.embedder import embedding_client
 from app.database.models import Chunk, Resource, User
 from app.config import llm_settings
 from app.services.whatsapp_service import whatsapp_client
@@ -28,30 +29,20 @@ async def generate_exercise(
             user.wa_id, strings.get_string(StringCategory.TOOLS, "exercise_generator")
         )
 
-        # Retrieve the relevant content and exercises
-        retrieved_content = await vector_search(
-            query=query,
-            n_results=7,
-            where={
-                "content_type": [ChunkType.text],
-                "resource_id": resources,
-            },
-        )
-        retrieved_exercises = await vector_search(
-            query=query,
-            n_results=3,
-            where={
-                "content_type": [ChunkType.exercise],
-                "resource_id": resources,
-            },
+        # Retrieve the relevant content and exercises (embedding the query only once)
+        query_vector = await embedding_client.get_embedding(query)
+        retrieved_content, retrieved_exercises = await vector_search_multi(
+            query_vector,
+            [
+                ({"content_type": [ChunkType.text], "resource_id": resources}, 7),
+                ({"content_type": [ChunkType.exercise], "resource_id": resources}, 3),
+            ],
         )
 
         logger.debug(
             f"Retrieved {len(retrieved_content)} content chunks, this is the first: {retrieved_content[0]}"
         )
-        logger.debug(
-            f"Retrieved {len(retrieved_content)} exercise chunks, this is the first: {retrieved_content[0]}"
-        )
+        logger.debug(f"Retrieved {len(retrieved_exercises)} exercise chunks")
 
         # Format the context and prompt
         context = _format_context(retrieved_content, retrieved_exercises)
@@ -0,0 +1,136 @@
+"""
+Small in-process cache primitives shared by the services.
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLSet:
+    """A bounded set whose members expire after ttl seconds (oldest evicted first)."""
+
+    def __init__(self, ttl: float, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: OrderedDict[Hashable, float] = OrderedDict()
+
+    def _purge(self, now: float) -> None:
+        while self._items:
+            key, expires_at = next(iter(self._items.items()))
+            if expires_at > now and len(self._items) <= self.max_size:
+                break
+            self._items.popitem(last=False)
+
+    def add(self, key: Hashable) -> None:
+        now = time.monotonic()
+        self._items[key] = now + self.ttl
+        self._items.move_to_end(key)
+        self._purge(now)
+
+    def discard(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires_at = self._items.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return False
+        return True
+
+    def __len__(self) -> int:
+        self._purge(time.monotonic())
+        return len(self._items)
+
+
+class LRUCache:
+    """
+    A least-recently-used cache bounded by entry count and/or total size in bytes, with
+    an optional time to live. Tracks hits and misses.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        size_of: Callable[[Any], int] = sys.getsizeof,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, size in bytes, expiry time or None)
+        self._items: OrderedDict[Hashable, Tuple[Any, int, Optional[float]]] = (
+            OrderedDict()
+        )
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        value, _, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.invalidate(key)
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+        """Store a value. Unless given, its size is measured with size_of (with max_bytes)."""
+        self.invalidate(key)
+        if size is None:
+            size = self.size_of(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._items[key] = (value, size, expires_at)
+        self.size_bytes += size
+
+        while (
+            self.max_entries is not None and len(self._items) > self.max_entries
+        ) or (self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._items.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+    def invalidate(self, key: Hashable) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size_bytes -= item[1]
+
+    def clear(self) -> None:
+        self._items.clear()
+        self.size_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._items),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 3),
+        }
@@ -0,0 +1,124 @@
+"""
+This module packs the conversation that is sent to the LLM into a per-model token budget.
+
+The system prompt and the new user messages are always kept. History is packed newest-first
+on top of them; when it does not fit, the outputs of earlier tool calls (retrieved chunks
+make up most of the prompt) are truncated first and only then are the oldest turns dropped.
+"""
+
+import logging
+from typing import List, Tuple
+
+from app.config import llm_settings
+from app.database.enums import MessageRole
+from app.database.models import Message
+from app.utils.llm_utils import REPLY_PRIMING_TOKENS, truncate_to_tokens
+from app.utils.token_counter import token_counter
+
+
+class ContextBuilder:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def budget_for(model: str) -> int:
+        return llm_settings.context_token_budgets.get(
+            model, llm_settings.default_context_token_budget
+        )
+
+    @staticmethod
+    def _group_turns(
+        history: List[dict], counts: List[int]
+    ) -> Tuple[List[List[dict]], List[int]]:
+        """
+        Split history into units that are kept or dropped together, so an assistant message
+        with tool calls is never sent without its tool messages (the API rejects that).
+        """
+        units: List[List[dict]] = []
+        unit_tokens: List[int] = []
+        for message, count in zip(history, counts):
+            if message["role"] == MessageRole.tool:
+                # Tool messages whose assistant message fell outside the history are dropped
+                if units and units[-1][0].get("tool_calls"):
+                    units[-1].append(message)
+                    unit_tokens[-1] += count
+                continue
+            units.append([message])
+            unit_tokens.append(count)
+        return units, unit_tokens
+
+    def build(
+        self,
+        system_message: dict,
+        history: List[Message],
+        new_messages: List[Message],
+        model: str,
+    ) -> Tuple[List[dict], int]:
+        """
+        Pack the system prompt, as much recent history as fits and the new messages.
+
+        Returns:
+            The messages in API format and their token count
+        """
+        budget = self.budget_for(model)
+        counts = token_counter.count_messages([*history, *new_messages])
+        units, unit_tokens = self._group_turns(
+            [msg.to_api_format() for msg in history], counts[: len(history)]
+        )
+        fixed_tokens = (
+            REPLY_PRIMING_TOKENS
+            + token_counter.count_api_messages([system_message])[0]
+            + sum(counts[len(history) :])
+        )
+
+        # First shrink stale tool outputs, oldest first, until the whole history fits
+        truncated = 0
+        for i, unit in enumerate(units):
+            if fixed_tokens + sum(unit_tokens) <= budget:
+                break
+            if not any(message["role"] == MessageRole.tool for message in unit):
+                continue
+            units[i] = [
+                (
+                    {
+                        **message,
+                        "content": truncate_to_tokens(
+                            message["content"],
+                            llm_settings.stale_tool_output_max_tokens,
+                        ),
+                    }
+                    if message["role"] == MessageRole.tool and message.get("content")
+                    else message
+                )
+                for message in unit
+            ]
+            unit_tokens[i] = sum(token_counter.count_api_messages(units[i]))
+            truncated += 1
+
+        # Then pack the history newest-first, stopping at the first turn that does not fit
+        packed: List[List[dict]] = []
+        total_tokens = fixed_tokens
+        for unit, tokens in zip(reversed(units), reversed(unit_tokens)):
+            if total_tokens + tokens > budget:
+                break
+            packed.append(unit)
+            total_tokens += tokens
+        dropped = len(units) - len(packed)
+
+        if total_tokens > budget:
+            self.logger.warning(
+                f"System prompt and new messages alone use {total_tokens} tokens, over the budget of {budget}"
+            )
+        if truncated or dropped:
+            self.logger.debug(
+                f"Context over budget: truncated {truncated} tool outputs, dropped {dropped} of {len(units)} history turns"
+            )
+
+        messages = [system_message]
+        for unit in reversed(packed):
+            messages.extend(unit)
+        messages.extend(msg.to_api_format() for msg in new_messages)
+        return messages, total_tokens
+
+
+context_builder = ContextBuilder()
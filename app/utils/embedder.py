@@ -1,8 +1,19 @@
-from typing import List
-from app.config import llm_settings
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+import backoff
+import httpx
+import openai
 from together import Together
 from openai import OpenAI
 
+from app.config import llm_settings
+from app.utils.embedding_cache import embedding_cache
+
+logger = logging.getLogger(__name__)
+
+# Synchronous client, used by the offline scripts (e.g. populating the chunks table)
 client = (
     OpenAI(api_key=llm_settings.llm_api_key.get_secret_value())
     if llm_settings.ai_provider == "openai"
@@ -24,3 +35,118 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
         input=texts,
     )
     return [embedding.embedding for embedding in response.data]
+
+
+class AsyncEmbedder:
+    """
+    Non-blocking embedder for the request path. Concurrent get_embedding calls that arrive
+    within a short window are coalesced into a single embeddings.create request, and all
+    requests share one pooled HTTP client.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+        self.client = openai.AsyncOpenAI(
+            base_url=(
+                "https://api.together.xyz/v1"
+                if llm_settings.ai_provider == "together"
+                else None
+            ),
+            api_key=llm_settings.llm_api_key.get_secret_value(),
+            http_client=self.http_client,
+            max_retries=0,  # Retries are handled by backoff in _create_embeddings
+        )
+        self.batch_window = llm_settings.embedding_batch_window_ms / 1000
+        self.max_batch_size = llm_settings.embedding_max_batch_size
+        # (cache key, text, future) of the requests waiting for the next batch
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+    async def get_embedding(self, text: str) -> List[float]:
+        # Only the cache key is normalized, the model embeds the text as it was given
+        key = embedding_cache.normalize(text)
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, text, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        return await future
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(self.get_embedding(t) for t in texts)))
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._embed_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _embed_batch(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        # Texts with the same cache key in the same window are only embedded once
+        texts: Dict[str, str] = {}
+        for key, text, _ in batch:
+            texts.setdefault(key, text)
+
+        try:
+            embeddings = await embedding_cache.get_persistent(list(texts))
+            missing = [key for key in texts if key not in embeddings]
+            if missing:
+                created = dict(
+                    zip(
+                        missing,
+                        await self._create_embeddings([texts[key] for key in missing]),
+                    )
+                )
+                embedding_cache.put_many(created)
+                embeddings.update(created)
+        except Exception as e:
+            self.logger.error(f"Failed to embed batch of {len(texts)} texts: {str(e)}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.logger.debug(
+            f"Embedded {len(missing)} texts for {len(batch)} requests, cache stats: {embedding_cache.stats}"
+        )
+        for key, _, future in batch:
+            if not future.done():
+                future.set_result(embeddings[key])
+
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=7, max_time=45)
+    async def _create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        try:
+            response = await self.client.embeddings.create(
+                model=llm_settings.embedding_model,
+                input=texts,
+            )
+            data = sorted(response.data, key=lambda item: item.index)
+            return [item.embedding for item in data]
+        except openai.RateLimitError:
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to retrieve embeddings: {str(e)}")
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+embedding_client = AsyncEmbedder()
@@ -0,0 +1,139 @@
+"""
+This module caches query embeddings so repeated questions skip the embedding API.
+
+Entries are keyed on (model, normalized text), the text itself is embedded unchanged. The
+first tier is an in-memory LRU bounded by bytes, the optional second tier is the
+embedding_cache table in Postgres, which is shared between workers and survives restarts.
+"""
+
+import asyncio
+import hashlib
+import logging
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+
+from app.config import llm_settings
+from app.database.engine import get_session
+from app.database.models import EmbeddingCacheEntry
+from app.utils.cache_utils import LRUCache
+
+
+def _embedding_size(embedding: array) -> int:
+    return embedding.itemsize * len(embedding) + 64
+
+
+class EmbeddingCache:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.model = llm_settings.embedding_model
+        self.ttl = llm_settings.embedding_cache_ttl_s
+        self.persistent = llm_settings.embedding_cache_persistent
+        # Embeddings are stored as packed doubles, a list of floats is ~4x larger
+        self.memory = LRUCache(
+            max_bytes=llm_settings.embedding_cache_max_bytes,
+            ttl=self.ttl,
+            size_of=_embedding_size,
+        )
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self._write_tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """The cache key of a text, so queries differing in case or whitespace share it."""
+        return " ".join(text.lower().split())
+
+    def _hash(self, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Look up a cache key in the in-memory tier."""
+        embedding = self.memory.get((self.model, text))
+        return embedding.tolist() if embedding is not None else None
+
+    def put_many(self, embeddings: Dict[str, List[float]]) -> None:
+        """Store embeddings by cache key in memory and (in the background) in Postgres."""
+        for text, embedding in embeddings.items():
+            self.memory.put((self.model, text), array("d", embedding))
+        if self.persistent and embeddings:
+            task = asyncio.create_task(self._store_persistent(embeddings))
+            self._write_tasks.add(task)
+            task.add_done_callback(self._write_tasks.discard)
+
+    async def get_persistent(self, texts: List[str]) -> Dict[str, List[float]]:
+        """Look up several cache keys in the Postgres tier with one query."""
+        if not self.persistent or not texts:
+            return {}
+
+        hashes = {self._hash(text): text for text in texts}
+        try:
+            async with get_session() as session:
+                result = await session.execute(
+                    select(
+                        EmbeddingCacheEntry.text_hash, EmbeddingCacheEntry.embedding
+                    ).where(
+                        EmbeddingCacheEntry.model == self.model,
+                        EmbeddingCacheEntry.text_hash.in_(hashes),
+                        EmbeddingCacheEntry.created_at
+                        > datetime.now(timezone.utc) - timedelta(seconds=self.ttl),
+                    )
+                )
+                found = {
+                    hashes[row.text_hash]: [float(x) for x in row.embedding]
+                    for row in result.fetchall()
+                }
+        except Exception as e:
+            # The cache is an optimization, never fail the request because of it
+            self.logger.error(f"Failed to read persistent embedding cache: {str(e)}")
+            return {}
+
+        self.persistent_hits += len(found)
+        self.persistent_misses += len(texts) - len(found)
+        for text, embedding in found.items():
+            self.memory.put((self.model, text), array("d", embedding))
+        return found
+
+    async def _store_persistent(self, embeddings: Dict[str, List[float]]) -> None:
+        try:
+            async with get_session() as session:
+                statement = insert(EmbeddingCacheEntry).values(
+                    [
+                        {
+                            "model": self.model,
+                            "text_hash": self._hash(text),
+                            "embedding": embedding,
+                        }
+                        for text, embedding in embeddings.items()
+                    ]
+                )
+                await session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=["model", "text_hash"],
+                        set_={
+                            "embedding": statement.excluded.embedding,
+                            "created_at": statement.excluded.created_at,
+                        },
+                    )
+                )
+        except Exception as e:
+            self.logger.error(f"Failed to write persistent embedding cache: {str(e)}")
+
+    @property
+    def stats(self) -> Dict[str, object]:
+        lookups = self.memory.hits + self.memory.misses
+        return {
+            "memory": self.memory.stats,
+            "persistent_hits": self.persistent_hits,
+            "persistent_misses": self.persistent_misses,
+            "hit_rate": round(
+                (self.memory.hits + self.persistent_hits) / lookups if lookups else 0.0,
+                3,
+            ),
+        }
+
+
+embedding_cache = EmbeddingCache()
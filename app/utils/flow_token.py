@@ -0,0 +1,164 @@
+"""
+Flow tokens tell the flows endpoint which user and flow a request belongs to.
+
+A token is base64url(version | nonce | AES-GCM(expiry | wa_id | flow_id)): about 80
+characters for a typical wa_id and flow_id, against about 120 for the Fernet tokens used
+before, and checked and decrypted with a single AEAD call. The expiry is part of the
+encrypted claims and checked on decode. Fernet tokens that were handed out before are
+still accepted (with the same TTL) until they expire.
+"""
+
+import base64
+import logging
+import os
+import struct
+import time
+from typing import List, NamedTuple, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from app.config import Settings, settings
+
+TOKEN_VERSION = 1
+NONCE_SIZE = 12
+# Expiry (unix seconds) and the length of the wa_id, followed by the wa_id and flow_id
+CLAIMS_HEADER = struct.Struct(">IB")
+# Every Fernet token starts with the version byte 0x80
+FERNET_PREFIX = "gAAAAA"
+
+
+class FlowTokenClaims(NamedTuple):
+    wa_id: str
+    flow_id: str
+    expires_at: Optional[int] = None
+
+
+class InvalidFlowTokenError(ValueError):
+    pass
+
+
+class ExpiredFlowTokenError(InvalidFlowTokenError):
+    pass
+
+
+class FlowTokenCodec:
+    """
+    Encodes and decodes flow tokens. The AES keys are derived from the Fernet keys in
+    FLOW_TOKEN_ENCRYPTION_KEY (comma separated, the first one encrypts), so rotating that
+    setting rotates both token formats.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.ttl = settings.flow_token_ttl_s
+        self._ciphers: List[AESGCM] = []
+        self._fernet: Optional[MultiFernet] = None
+
+    def load(self, source: Settings = settings) -> None:
+        if source.flow_token_encryption_key is None:
+            raise ValueError("FLOW_TOKEN_ENCRYPTION_KEY is not set")
+        keys = source.flow_token_encryption_key.get_secret_value().split(",")
+        self.load_keys([key.strip() for key in keys if key.strip()])
+        self.ttl = source.flow_token_ttl_s
+
+    def load_keys(self, keys: List[str]) -> None:
+        """Use these Fernet keys, the first one encrypts new tokens."""
+        ciphers = [AESGCM(self._derive_key(key)) for key in keys]
+        fernet = MultiFernet([Fernet(key) for key in keys])
+        self._ciphers, self._fernet = ciphers, fernet
+
+    def reload(self) -> None:
+        """Load the keys from the environment again, e.g. after rotating them."""
+        self.load(Settings())
+        self.logger.info("Reloaded the flow token keys")
+
+    @staticmethod
+    def _derive_key(fernet_key: str) -> bytes:
+        return HKDF(
+            algorithm=hashes.SHA256(), length=16, salt=None, info=b"twiga flow token"
+        ).derive(base64.urlsafe_b64decode(fernet_key))
+
+    @property
+    def ciphers(self) -> List[AESGCM]:
+        if not self._ciphers:
+            self.load()
+        return self._ciphers
+
+    def encode(self, wa_id: str, flow_id: str, ttl: Optional[int] = None) -> str:
+        wa_id_bytes = wa_id.encode("utf-8")
+        expires_at = int(time.time()) + (self.ttl if ttl is None else ttl)
+        claims = (
+            CLAIMS_HEADER.pack(expires_at, len(wa_id_bytes))
+            + wa_id_bytes
+            + flow_id.encode("utf-8")
+        )
+        header = bytes([TOKEN_VERSION])
+        nonce = os.urandom(NONCE_SIZE)
+        # The version is authenticated as associated data
+        sealed = self.ciphers[0].encrypt(nonce, claims, header)
+        return base64.urlsafe_b64encode(header + nonce + sealed).rstrip(b"=").decode()
+
+    def decode(self, token: str, now: Optional[float] = None) -> FlowTokenClaims:
+        """
+        Decrypt and check a flow token. Raises InvalidFlowTokenError if it isn't valid,
+        or if the keys to check it with aren't configured.
+        """
+        if not token:
+            raise InvalidFlowTokenError("Missing flow token")
+        try:
+            if token.startswith(FERNET_PREFIX):
+                return self._decode_fernet(token)
+            return self._decode(token, time.time() if now is None else now)
+        except InvalidFlowTokenError:
+            raise
+        except (ValueError, struct.error) as e:
+            # Malformed claims, or FLOW_TOKEN_ENCRYPTION_KEY is missing or invalid
+            raise InvalidFlowTokenError(f"Flow token could not be decoded: {e}") from e
+
+    def _decode(self, token: str, now: float) -> FlowTokenClaims:
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            raise InvalidFlowTokenError("Malformed flow token")
+        if len(raw) <= 1 + NONCE_SIZE or raw[0] != TOKEN_VERSION:
+            raise InvalidFlowTokenError("Unknown flow token format")
+
+        header, nonce, sealed = raw[:1], raw[1 : 1 + NONCE_SIZE], raw[1 + NONCE_SIZE :]
+        for cipher in self.ciphers:
+            try:
+                claims = cipher.decrypt(nonce, sealed, header)
+                break
+            except InvalidTag:
+                continue
+        else:
+            raise InvalidFlowTokenError("Flow token could not be decrypted")
+
+        expires_at, wa_id_length = CLAIMS_HEADER.unpack_from(claims)
+        if expires_at < now:
+            raise ExpiredFlowTokenError("Flow token has expired")
+        body = claims[CLAIMS_HEADER.size :]
+        return FlowTokenClaims(
+            wa_id=body[:wa_id_length].decode("utf-8"),
+            flow_id=body[wa_id_length:].decode("utf-8"),
+            expires_at=expires_at,
+        )
+
+    def _decode_fernet(self, token: str) -> FlowTokenClaims:
+        if self._fernet is None:
+            self.load()
+        try:
+            data = self._fernet.decrypt(token.encode("utf-8"), ttl=self.ttl)
+        except InvalidToken:
+            raise InvalidFlowTokenError("Invalid or expired flow token")
+        # Legacy tokens are "{wa_id}_{flow_id}", wa_ids are digits only
+        wa_id, _, flow_id = data.decode("utf-8").partition("_")
+        if not wa_id or not flow_id:
+            raise InvalidFlowTokenError("Malformed flow token")
+        return FlowTokenClaims(wa_id=wa_id, flow_id=flow_id)
+
+
+flow_tokens = FlowTokenCodec()
@@ -1,71 +1,190 @@
+import asyncio
 import base64
 import json
-from typing import Any, Dict, List, Tuple
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding, rsa
 import logging
 from app.database.db import get_user_by_waid
 from app.services.whatsapp_service import whatsapp_client
 
-import httpx
-from app.config import settings
-from cryptography.fernet import Fernet
+from app.config import Settings, settings
 
 from app.database.models import User
+from app.utils.cache_utils import LRUCache
+from app.utils.flow_token import flow_tokens
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
 
-def decrypt_aes_key(encrypted_aes_key: str) -> bytes:
-    private_key_pem = settings.whatsapp_business_private_key.get_secret_value()
-    password = settings.whatsapp_business_private_key_password.get_secret_value()
 
-    private_key = serialization.load_pem_private_key(
-        private_key_pem.encode(),
-        password=password.encode(),
-        backend=default_backend(),
-    )
+# While flow requests come in, the crypto pool's queue depth is logged this often
+CRYPTO_STATS_INTERVAL_S = 60.0
+
+# RSA-OAEP parameters Meta uses to encrypt the AES key of each flow request
+OAEP_PADDING = asym_padding.OAEP(
+    mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None,
+)
+
+
+class FlowCryptoContext:
+    """
+    Holds the parsed business private key, so a flow request doesn't pay for parsing (and
+    password-decrypting) the PEM again. The key is loaded on first use or with load() at
+    startup, and reload() picks up a rotated key. Flow tokens have their own keys, see
+    app/utils/flow_token.py.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._private_key: Optional[rsa.RSAPrivateKey] = None
+
+    def load(self, source: Settings = settings) -> None:
+        if source.whatsapp_business_private_key is None:
+            self._private_key = None
+            return
+        password = source.whatsapp_business_private_key_password
+        self.load_private_key(
+            source.whatsapp_business_private_key.get_secret_value().encode(),
+            password.get_secret_value().encode() if password else None,
+        )
+
+    def load_private_key(self, pem: bytes, password: Optional[bytes]) -> None:
+        self._private_key = serialization.load_pem_private_key(pem, password=password)
+
+    def reload(self) -> None:
+        """Load the keys from the environment again, e.g. after rotating them."""
+        self.load(Settings())
+        self.logger.info("Reloaded the flow private key")
+
+    @property
+    def private_key(self) -> rsa.RSAPrivateKey:
+        if self._private_key is None:
+            self.load()
+        if self._private_key is None:
+            raise ValueError("WHATSAPP_BUSINESS_PRIVATE_KEY is not set")
+        return self._private_key
+
+    def decrypt_aes_key(self, encrypted_aes_key: str) -> bytes:
+        return self.private_key.decrypt(
+            base64.b64decode(encrypted_aes_key), OAEP_PADDING
+        )
+
+    @staticmethod
+    def decrypt_payload(encrypted_data: str, aes_key: bytes, iv: str) -> dict:
+        # AESGCM expects the 16 byte tag at the end of the data, which is how Meta sends it
+        decrypted_data_bytes = AESGCM(aes_key).decrypt(
+            base64.b64decode(iv), base64.b64decode(encrypted_data), None
+        )
+        return json.loads(decrypted_data_bytes)
+
+    @staticmethod
+    def encrypt_response(response_bytes: bytes, aes_key: bytes, iv: str) -> str:
+        """Encrypt a flow response with the request's key and its inverted IV."""
+        inverted_iv_bytes = bytes(~b & 0xFF for b in base64.b64decode(iv))
+        encrypted_data_bytes = AESGCM(aes_key).encrypt(
+            inverted_iv_bytes, response_bytes, None
+        )
+        return base64.b64encode(encrypted_data_bytes).decode("utf-8")
+
+
+flow_crypto = FlowCryptoContext()
+
+
+class FlowCryptoPool:
+    """
+    Runs the CPU bound flow crypto (the RSA-OAEP decrypt of each request) on a bounded
+    pool of threads instead of the event loop. cryptography releases the GIL while it
+    works, so a burst of flow submissions doesn't stall the chat requests.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Jobs beyond the workers and the queue wait here, before reaching the executor
+        self._slots = asyncio.Semaphore(workers + max_queue)
+        self._in_flight = 0
+        self.jobs = 0
+        # Since the last stats report
+        self.peak_queue_depth = 0
+        self._last_report: Optional[float] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="flow-crypto"
+            )
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs waiting for a free worker thread."""
+        return max(0, self._in_flight - self.workers)
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        async with self._slots:
+            self._in_flight += 1
+            depth = self.queue_depth
+            if depth > self.peak_queue_depth:
+                self.peak_queue_depth = depth
+            if depth >= self.max_queue:
+                self.logger.warning(f"Flow crypto queue is full: {self.stats}")
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, func, *args)
+            finally:
+                self._in_flight -= 1
+                self.jobs += 1
+                self._report(loop.time())
+
+    def _report(self, now: float) -> None:
+        """Log the stats at most every CRYPTO_STATS_INTERVAL_S, then reset the peak."""
+        if self._last_report is None:
+            self._last_report = now
+        elif now - self._last_report >= CRYPTO_STATS_INTERVAL_S:
+            self.logger.info(f"Flow crypto pool stats: {self.stats}")
+            self._last_report = now
+            self.peak_queue_depth = self.queue_depth
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "jobs": self.jobs,
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+flow_crypto_pool = FlowCryptoPool(
+    workers=settings.flow_crypto_workers, max_queue=settings.flow_crypto_max_queue
+)
 
-    decrypted_key = private_key.decrypt(
-        base64.b64decode(encrypted_aes_key),
-        asym_padding.OAEP(
-            mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None,
-        ),
-    )
 
-    return decrypted_key
+def decrypt_aes_key(encrypted_aes_key: str) -> bytes:
+    return flow_crypto.decrypt_aes_key(encrypted_aes_key)
 
 
 def decrypt_payload(encrypted_data: str, aes_key: bytes, iv: str) -> dict:
-    encrypted_data_bytes = base64.b64decode(encrypted_data)
-    iv_bytes = base64.b64decode(iv)
-    encrypted_data_body = encrypted_data_bytes[:-16]
-    encrypted_data_tag = encrypted_data_bytes[-16:]
-    decryptor = Cipher(
-        algorithms.AES(aes_key),
-        modes.GCM(iv_bytes, encrypted_data_tag),
-        backend=default_backend(),
-    ).decryptor()
-    decrypted_data_bytes = decryptor.update(encrypted_data_body) + decryptor.finalize()
-    return json.loads(decrypted_data_bytes.decode("utf-8"))
-
-
-def encrypt_response(response: dict, aes_key: bytes, iv: str) -> str:
-    response_bytes = json.dumps(response).encode("utf-8")
-    iv_bytes = base64.b64decode(iv)
-    encryptor = Cipher(
-        algorithms.AES(aes_key),
-        modes.GCM(iv_bytes),
-        backend=default_backend(),
-    ).encryptor()
-    encrypted_data = encryptor.update(response_bytes) + encryptor.finalize()
-    encrypted_data_tag = encryptor.tag
-    encrypted_data_bytes = encrypted_data + encrypted_data_tag
-    return base64.b64encode(encrypted_data_bytes).decode("utf-8")
+    return flow_crypto.decrypt_payload(encrypted_data, aes_key, iv)
+
+
+async def decrypt_flow_webhook_async(body: dict) -> dict:
+    """decrypt_flow_webhook on the flow crypto thread pool."""
+    return await flow_crypto_pool.run(decrypt_flow_webhook, body)
 
 
 def decrypt_flow_webhook(body: dict) -> dict:
@@ -73,8 +192,10 @@ def decrypt_flow_webhook(body: dict) -> dict:
     encrypted_aes_key = body["encrypted_aes_key"]
     initial_vector = body["initial_vector"]
 
-    aes_key = decrypt_aes_key(encrypted_aes_key)
-    decrypted_payload = decrypt_payload(encrypted_flow_data, aes_key, initial_vector)
+    aes_key = flow_crypto.decrypt_aes_key(encrypted_aes_key)
+    decrypted_payload = flow_crypto.decrypt_payload(
+        encrypted_flow_data, aes_key, initial_vector
+    )
 
     return {
         "decrypted_payload": decrypted_payload,
@@ -83,41 +204,13 @@ def decrypt_flow_webhook(body: dict) -> dict:
     }
 
 
-def get_fernet_key() -> bytes:
-    key = settings.flow_token_encryption_key.get_secret_value()
-    if isinstance(key, str):
-        key = key.encode("utf-8")
-    return key
-
-
 def decrypt_flow_token(encrypted_flow_token: str) -> tuple:
-    key = get_fernet_key()
-    fernet = Fernet(key)
-
-    try:
-        decrypted_data = fernet.decrypt(encrypted_flow_token.encode("utf-8"))
-        # logging.info(f"Decrypted data: {decrypted_data}")
-        decrypted_str = decrypted_data.decode("utf-8")
-        wa_id, flow_id = decrypted_str.split("_")
-        return wa_id, flow_id
-    except Exception as e:
-        logging.error(f"Decryption failed: {e}")
-        raise
+    claims = flow_tokens.decode(encrypted_flow_token)
+    return claims.wa_id, claims.flow_id
 
 
 def encrypt_flow_token(wa_id: str, flow_id: str) -> str:
-    key = get_fernet_key()
-    # logging.info(f"Encryption Key: {key}")
-    fernet = Fernet(key)
-
-    # log wa_id and flow_id
-    logging.info(f"going to encrypt wa_id: {wa_id} and flow_id: {flow_id}")
-
-    data = f"{wa_id}_{flow_id}".encode("utf-8")
-    # logging.info(f"Data to encrypt: {data}")
-    encrypted_data = fernet.encrypt(data)
-    # logging.info(f"Encrypted data: {encrypted_data}")
-    return encrypted_data.decode("utf-8")
+    return flow_tokens.encode(wa_id, flow_id)
 
 
 async def send_whatsapp_flow_message(
@@ -165,16 +258,8 @@ async def send_whatsapp_flow_message(
         },
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"https://graph.facebook.com/{settings.meta_api_version}/{settings.whatsapp_cloud_number_id}/messages",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {settings.whatsapp_api_token.get_secret_value()}",
-            },
-            json=payload,
-        )
-        logger.info(f"WhatsApp API response: {response.status_code} - {response.text}")
+    response = await whatsapp_client.post_message(json.dumps(payload))
+    logger.info(f"WhatsApp API response: {response.status_code} - {response.text}")
 
 
 def create_flow_response_payload(
@@ -200,26 +285,6 @@ def create_flow_response_payload(
     }
 
 
-def handle_token_validation(
-    logger: logging.Logger, encrypted_flow_token: str
-) -> Tuple[str, str]:
-    """
-    Validate and decrypt flow token
-    Returns (wa_id, flow_id) or raises exception
-    """
-    if not encrypted_flow_token:
-        logger.error("Missing flow token")
-        raise ValueError("Missing flow token")
-
-    try:
-        wa_id, flow_id = decrypt_flow_token(encrypted_flow_token)
-        logger.info(f"Decrypted flow token: {wa_id}, {flow_id}")
-        return wa_id, flow_id
-    except Exception as e:
-        logger.error(f"Error decrypting flow token: {e}")
-        raise ValueError("Invalid flow token")
-
-
 async def validate_user(logger: logging.Logger, wa_id: str) -> User:
     """
     Validate and retrieve user
@@ -248,6 +313,64 @@ async def handle_error_response(
     logger.error(error_message)
 
 
+def create_select_subjects_payload(subjects: List[dict]) -> Dict[str, Any]:
+    """
+    Create the subject selection payload
+    """
+    has_subjects = len(subjects) > 0
+    return {
+        # The client expects a list of subjects with id and title, even if it is empty
+        "subjects": (
+            subjects
+            if has_subjects
+            else [{"id": "0", "title": "No subjects available"}]
+        ),
+        "has_subjects": has_subjects,
+        "no_subjects_text": "Sorry, currently there are no active subjects.",
+        "select_subject_text": "This helps us find the best answers for your questions.",
+    }
+
+
+class FlowPayloadCache:
+    """
+    Flow screens that only depend on the catalog (the subject and class lists) are the
+    same for every user, so their JSON is serialized once per (screen, subject_id, catalog
+    version) and each request only encrypts the cached bytes. A new catalog version
+    changes the key, so stale payloads are never served and simply age out of the LRU.
+    """
+
+    def __init__(self, max_entries: int, enabled: bool = True):
+        self.enabled = enabled
+        self.cache = LRUCache(max_entries=max_entries)
+
+    def get(
+        self,
+        screen: str,
+        subject_id: Optional[int],
+        catalog_version: int,
+        build: Callable[[], Dict[str, Any]],
+    ) -> bytes:
+        """Return the serialized payload, calling build to create it on a miss."""
+        if not self.enabled:
+            return json.dumps(build()).encode("utf-8")
+        key = (screen, subject_id, catalog_version)
+        payload = self.cache.get(key)
+        if payload is None:
+            payload = json.dumps(build()).encode("utf-8")
+            self.cache.put(key, payload, size=len(payload))
+        return payload
+
+    @property
+    def stats(self) -> dict:
+        return self.cache.stats
+
+
+flow_payload_cache = FlowPayloadCache(
+    max_entries=settings.flow_payload_cache_max_entries,
+    enabled=settings.flow_payload_cache_enabled,
+)
+
+
 def create_subject_class_payload(
     subject_title: str, classes: List[dict], is_update: bool, subject_id: str
 ) -> Dict[str, Any]:
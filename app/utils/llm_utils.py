@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import List
 import json
 import logging
@@ -21,29 +22,83 @@ else:
     llm_client = openai.AsyncOpenAI(api_key=llm_settings.llm_api_key.get_secret_value())
 
 
+# Above this many strings, encoding is spread over tiktoken's thread pool
+ENCODE_BATCH_THRESHOLD = 32
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """Load a tiktoken encoding once per process, loading it is expensive."""
+    return tiktoken.get_encoding(encoding_name)
+
+
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """This returns the number of OpenAI-equivalent tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(get_encoding(encoding_name).encode_ordinary(string))
+
+
+def num_tokens_from_strings(
+    strings: List[str], encoding_name: str = "cl100k_base"
+) -> List[int]:
+    """Return the number of OpenAI-equivalent tokens of each string, encoded as one batch."""
+    encoding = get_encoding(encoding_name)
+    if len(strings) >= ENCODE_BATCH_THRESHOLD:
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(strings)]
+    return [len(encoding.encode_ordinary(string)) for string in strings]
+
+
+def truncate_to_tokens(
+    string: str, max_tokens: int, encoding_name: str = "cl100k_base"
+) -> str:
+    """Cut a text string down to at most max_tokens OpenAI-equivalent tokens."""
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode_ordinary(string)
+    if len(tokens) <= max_tokens:
+        return string
+    return encoding.decode(tokens[:max_tokens]) + " ...[truncated]"
+
+
+def _countable_strings(message: dict) -> List[str]:
+    """The parts of a message in API format that are tokenized by the model."""
+    strings = []
+    for key, value in message.items():
+        if value is None or key == "tool_call_id":
+            continue
+        if key == "tool_calls":
+            strings.append(json.dumps(value))
+        else:
+            strings.append(str(value))
+    return strings
+
+
+def num_tokens_per_message(
+    messages: List[dict], encoding_name: str = "cl100k_base"
+) -> List[int]:
+    """Return the number of tokens of each message in API format, encoded as one batch."""
+    parts = [_countable_strings(message) for message in messages]
+    lengths = iter(
+        num_tokens_from_strings(
+            [string for strings in parts for string in strings], encoding_name
+        )
+    )
+
+    counts = []
+    for message, strings in zip(messages, parts):
+        num_tokens = TOKENS_PER_MESSAGE + sum(next(lengths) for _ in strings)
+        if message.get("name") is not None:
+            num_tokens += TOKENS_PER_NAME
+        counts.append(num_tokens)
+    return counts
 
 
 def num_tokens_from_messages(
     messages: List[dict], encoding_name: str = "cl100k_base"
 ) -> int:
     """Return the number of tokens used by a list of messages in the format sent to the OpenAI or Groq API."""
-    tokens_per_message = 3
-    tokens_per_name = 1
-
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += num_tokens_from_string(value, encoding_name)
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return sum(num_tokens_per_message(messages, encoding_name)) + REPLY_PRIMING_TOKENS
 
 
 @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=7, max_time=45)
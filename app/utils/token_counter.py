@@ -0,0 +1,46 @@
+"""
+This module counts prompt tokens for stored messages.
+
+Stored messages never change, so their counts are memoized per Message.id and a turn
+only encodes the messages it has not seen before.
+"""
+
+from typing import List
+
+from app.database.models import Message
+from app.utils.cache_utils import LRUCache
+from app.utils.llm_utils import num_tokens_per_message
+
+
+class TokenCounter:
+    def __init__(self, encoding_name: str = "cl100k_base", max_entries: int = 50_000):
+        self.encoding_name = encoding_name
+        self.counts = LRUCache(max_entries=max_entries)
+
+    def count_api_messages(self, messages: List[dict]) -> List[int]:
+        """Count messages in API format (e.g. the system prompt), without memoizing."""
+        return num_tokens_per_message(messages, self.encoding_name)
+
+    def count_messages(self, messages: List[Message]) -> List[int]:
+        """Count stored messages, encoding only the ones without a memoized count."""
+        counts = [
+            self.counts.get(message.id) if message.id is not None else None
+            for message in messages
+        ]
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            new_counts = self.count_api_messages(
+                [messages[i].to_api_format() for i in missing]
+            )
+            for i, count in zip(missing, new_counts):
+                counts[i] = count
+                if messages[i].id is not None:
+                    self.counts.put(messages[i].id, count)
+        return counts
+
+    @property
+    def stats(self) -> dict:
+        return self.counts.stats
+
+
+token_counter = TokenCounter()
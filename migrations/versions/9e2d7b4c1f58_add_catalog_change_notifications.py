@@ -0,0 +1,48 @@
+"""add catalog change notifications
+
+Revision ID: 9e2d7b4c1f58
+Revises: d8f1b3e5a706
+Create Date: 2024-12-09 14:12:41.527390
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9e2d7b4c1f58"
+down_revision: Union[str, None] = "d8f1b3e5a706"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The app reloads its catalog snapshot (app/database/catalog.py) when these tables change
+CATALOG_TABLES = ["subjects", "classes", "classes_resources"]
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table in CATALOG_TABLES:
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_notify_catalog_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed()
+            """
+        )
+
+
+def downgrade() -> None:
+    for table in CATALOG_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_catalog_changed ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS notify_catalog_changed()")
@@ -0,0 +1,114 @@
+"""
+Measure the per-request crypto cost of the flows endpoint: decrypting the AES key and
+payload of a request, encrypting the response and the flow token round trip. The old
+path parses the PEM private key and uses Fernet tokens, the new path uses the key
+FlowCryptoContext parsed once and the compact AES-GCM flow tokens. Uses throwaway keys, so no secrets are needed:
+
+    python -m scripts.benchmarks.flow_crypto --requests 2000
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import statistics
+import time
+from typing import Callable, List
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from app.utils.flow_token import FlowTokenCodec
+from app.utils.flows_util import OAEP_PADDING, FlowCryptoContext
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PASSWORD = b"benchmark"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_request(public_key: rsa.RSAPublicKey) -> dict:
+    """A request body encrypted the way Meta encrypts flow requests."""
+    aes_key = AESGCM.generate_key(bit_length=128)
+    iv = os.urandom(16)
+    payload = json.dumps({"action": "data_exchange", "data": {"x": "y" * 200}})
+    return {
+        "encrypted_aes_key": base64.b64encode(
+            public_key.encrypt(aes_key, OAEP_PADDING)
+        ).decode(),
+        "encrypted_flow_data": base64.b64encode(
+            AESGCM(aes_key).encrypt(iv, payload.encode(), None)
+        ).decode(),
+        "initial_vector": base64.b64encode(iv).decode(),
+    }
+
+
+def measure(name: str, handle: Callable[[dict], None], requests: List[dict]) -> None:
+    latencies = []
+    for body in requests:
+        start = time.perf_counter()
+        handle(body)
+        latencies.append((time.perf_counter() - start) * 1000)
+    logger.info(
+        f"{name}: p50={statistics.median(latencies):.3f}ms "
+        f"p99={percentile(latencies, 99):.3f}ms per request"
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.BestAvailableEncryption(PASSWORD),
+    )
+    fernet_key = Fernet.generate_key()
+    requests = [make_request(private_key.public_key()) for _ in range(args.requests)]
+    response = json.dumps({"screen": "SUCCESS", "data": {}}).encode()
+
+    def per_request_parsing(body: dict) -> None:
+        # What every request used to do
+        key = serialization.load_pem_private_key(pem, password=PASSWORD)
+        aes_key = key.decrypt(base64.b64decode(body["encrypted_aes_key"]), OAEP_PADDING)
+        FlowCryptoContext.decrypt_payload(
+            body["encrypted_flow_data"], aes_key, body["initial_vector"]
+        )
+        FlowCryptoContext.encrypt_response(response, aes_key, body["initial_vector"])
+        token = Fernet(fernet_key).encrypt(b"255700000000_1234")
+        Fernet(fernet_key).decrypt(token)
+
+    context = FlowCryptoContext()
+    context.load_private_key(pem, PASSWORD)
+    tokens = FlowTokenCodec()
+    tokens.load_keys([fernet_key.decode()])
+    token = tokens.encode("255700000000", "1234")
+    logger.info(
+        f"Token size: {len(Fernet(fernet_key).encrypt(b'255700000000_1234'))} bytes "
+        f"(Fernet), {len(token)} bytes (compact)"
+    )
+
+    def cached_context(body: dict) -> None:
+        aes_key = context.decrypt_aes_key(body["encrypted_aes_key"])
+        context.decrypt_payload(
+            body["encrypted_flow_data"], aes_key, body["initial_vector"]
+        )
+        context.encrypt_response(response, aes_key, body["initial_vector"])
+        tokens.decode(tokens.encode("255700000000", "1234"))
+
+    measure("Parse keys per request", per_request_parsing, requests)
+    measure("FlowCryptoContext and compact tokens", cached_context, requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    main(parser.parse_args())
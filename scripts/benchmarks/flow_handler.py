@@ -0,0 +1,143 @@
+"""
+Measure the end-to-end latency of the /flows handler for the select subjects INIT
+request, with and without the serialized payload cache: decrypting the request on the
+crypto pool, decoding the flow token, building the screen and encrypting the response.
+The RSA decrypt dominates the end-to-end numbers, so the payload stage (build and
+serialize vs. cache lookup) is also measured on its own.
+
+Uses throwaway keys and a synthetic catalog, so neither secrets nor a database are
+needed. Run with:
+
+    python -m scripts.benchmarks.flow_handler --requests 2000 --subjects 40
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import statistics
+import time
+from typing import List
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import BackgroundTasks
+
+from app.config import settings
+from app.database.catalog import CatalogSnapshot, catalog
+from app.services.flow_service import flow_client
+from app.utils.flow_token import flow_tokens
+from app.utils.flows_util import (
+    OAEP_PADDING,
+    create_flow_response_payload,
+    create_select_subjects_payload,
+    flow_crypto,
+    flow_crypto_pool,
+    flow_payload_cache,
+)
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_request(public_key: rsa.RSAPublicKey, flow_token: str) -> dict:
+    """A select subjects INIT request encrypted the way Meta encrypts flow requests."""
+    aes_key = AESGCM.generate_key(bit_length=128)
+    iv = os.urandom(16)
+    payload = json.dumps({"action": "INIT", "flow_token": flow_token, "version": "3.0"})
+    return {
+        "encrypted_aes_key": base64.b64encode(
+            public_key.encrypt(aes_key, OAEP_PADDING)
+        ).decode(),
+        "encrypted_flow_data": base64.b64encode(
+            AESGCM(aes_key).encrypt(iv, payload.encode(), None)
+        ).decode(),
+        "initial_vector": base64.b64encode(iv).decode(),
+    }
+
+
+async def measure(name: str, requests: List[dict]) -> None:
+    latencies = []
+    for body in requests:
+        start = time.perf_counter()
+        response = await flow_client.handle_flow_webhook(body, BackgroundTasks())
+        latencies.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f"Handler failed: {response.body!r}")
+    logger.info(
+        f"{name}: p50={statistics.median(latencies):.3f}ms "
+        f"p99={percentile(latencies, 99):.3f}ms per request"
+    )
+
+
+def measure_payload_stage(name: str, subjects: List[dict], iterations: int) -> None:
+    version = catalog.version
+    start = time.perf_counter()
+    for _ in range(iterations):
+        flow_payload_cache.get(
+            "select_subjects",
+            None,
+            version,
+            lambda: create_flow_response_payload(
+                screen="select_subjects",
+                data=create_select_subjects_payload(subjects),
+            ),
+        )
+    per_call = (time.perf_counter() - start) / iterations * 1_000_000
+    logger.info(f"{name} (payload stage only): {per_call:.2f}us per request")
+
+
+async def main(args: argparse.Namespace) -> None:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    flow_crypto.load_private_key(
+        private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ),
+        None,
+    )
+    flow_tokens.load_keys([Fernet.generate_key().decode()])
+    settings.select_subjects_flow_id = settings.select_subjects_flow_id or "bench"
+
+    # A synthetic catalog in place of the one loaded from the database
+    subjects = [
+        {"id": str(subject_id), "title": f"Subject {subject_id}"}
+        for subject_id in range(1, args.subjects + 1)
+    ]
+    catalog._snapshot = CatalogSnapshot(
+        version=1, subjects=subjects, subject_classes={}
+    )
+
+    token = flow_tokens.encode("255700000000", settings.select_subjects_flow_id)
+    requests = [
+        make_request(private_key.public_key(), token) for _ in range(args.requests)
+    ]
+    try:
+        flow_payload_cache.enabled = False
+        await measure("Payload built per request", requests)
+        measure_payload_stage("Payload built per request", subjects, args.requests * 10)
+        flow_payload_cache.enabled = True
+        await measure("Cached serialized payload", requests)
+        measure_payload_stage("Cached serialized payload", subjects, args.requests * 10)
+        logger.info(f"Payload cache: {flow_payload_cache.stats}")
+    finally:
+        flow_crypto_pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--subjects", type=int, default=40)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,176 @@
+"""
+Benchmark the message history queries on a large, seeded messages table.
+
+The rows are written to a copy of the messages table in a separate `bench` schema (with
+the same indexes, so run the migrations first), which is dropped afterwards unless --keep
+is given. The script prints the query plans and the fetch latencies. Run with:
+
+    python -m scripts.benchmarks.message_history --rows 10000000 --users 20000
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.database.engine import db_engine
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEED_BATCH_SIZE = 1_000_000
+
+# The same statements as get_user_message_history and get_user_message_page
+HISTORY_QUERY = """
+    SELECT * FROM bench.messages
+    WHERE user_id = :user_id
+    ORDER BY created_at DESC, id DESC
+    LIMIT :limit
+"""
+HISTORY_IDS_QUERY = """
+    SELECT id, created_at FROM bench.messages
+    WHERE user_id = :user_id
+    ORDER BY created_at DESC, id DESC
+    LIMIT :limit
+"""
+PAGE_QUERY = """
+    SELECT * FROM bench.messages
+    WHERE user_id = :user_id
+      AND (created_at, id) < (
+        SELECT c.created_at, c.id FROM bench.messages c
+        WHERE c.id = :before_id AND c.user_id = :user_id
+      )
+    ORDER BY created_at DESC, id DESC
+    LIMIT :limit
+"""
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def seed(conn: AsyncConnection, rows: int, users: int) -> None:
+    await conn.execute(text("DROP SCHEMA IF EXISTS bench CASCADE"))
+    await conn.execute(text("CREATE SCHEMA bench"))
+    # Copies the columns and indexes, but not the foreign key to users
+    await conn.execute(
+        text(
+            "CREATE TABLE bench.messages (LIKE public.messages INCLUDING DEFAULTS INCLUDING INDEXES)"
+        )
+    )
+
+    for start in range(1, rows + 1, SEED_BATCH_SIZE):
+        stop = min(start + SEED_BATCH_SIZE - 1, rows)
+        await conn.execute(
+            text(
+                """
+                INSERT INTO bench.messages (id, user_id, role, content, created_at)
+                SELECT g,
+                       1 + (g % :users),
+                       CASE WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END,
+                       md5(g::text),
+                       now() - make_interval(secs => :rows - g)
+                FROM generate_series(:start, :stop) AS g
+            """
+            ),
+            {"users": users, "rows": rows, "start": start, "stop": stop},
+        )
+        logger.info(f"Seeded {stop}/{rows} rows")
+
+    # Sets the visibility map (needed for index-only scans) and the planner statistics
+    await conn.execute(text("VACUUM (ANALYZE) bench.messages"))
+
+
+async def explain(conn: AsyncConnection, name: str, query: str, params: dict) -> None:
+    result = await conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"), params)
+    plan = "\n".join(row[0] for row in result.fetchall())
+    logger.info(f"{name} plan:\n{plan}")
+    if "Sort" in plan:
+        logger.warning(f"{name} sorts rows instead of reading them in index order")
+
+
+async def measure(
+    conn: AsyncConnection, name: str, query: str, users: int, fetches: int, limit: int
+) -> None:
+    latencies = []
+    for _ in range(fetches):
+        params = {"user_id": random.randint(1, users), "limit": limit}
+        start = time.perf_counter()
+        (await conn.execute(text(query), params)).fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    logger.info(
+        f"{name}: p50={statistics.median(latencies):.3f}ms "
+        f"p99={percentile(latencies, 99):.3f}ms (including the round trip)"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        async with db_engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if not args.skip_seed:
+                await seed(conn, args.rows, args.users)
+
+            user_id = random.randint(1, args.users)
+            ids = (
+                await conn.execute(
+                    text(HISTORY_IDS_QUERY), {"user_id": user_id, "limit": args.limit}
+                )
+            ).fetchall()
+            await explain(
+                conn,
+                "History",
+                HISTORY_QUERY,
+                {"user_id": user_id, "limit": args.limit},
+            )
+            await explain(
+                conn,
+                "History ids (index-only)",
+                HISTORY_IDS_QUERY,
+                {"user_id": user_id, "limit": args.limit},
+            )
+            if ids:
+                await explain(
+                    conn,
+                    "Keyset page",
+                    PAGE_QUERY,
+                    {"user_id": user_id, "before_id": ids[-1].id, "limit": args.limit},
+                )
+
+            await measure(
+                conn, "History", HISTORY_QUERY, args.users, args.fetches, args.limit
+            )
+            await measure(
+                conn,
+                "History ids",
+                HISTORY_IDS_QUERY,
+                args.users,
+                args.fetches,
+                args.limit,
+            )
+
+            if not args.keep:
+                await conn.execute(text("DROP SCHEMA bench CASCADE"))
+    finally:
+        await db_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--fetches", type=int, default=1000)
+    parser.add_argument(
+        "--skip-seed", action="store_true", help="Reuse the table of a --keep run"
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep the bench schema")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,197 @@
+"""
+Compare the ways of storing the assistant and tool messages of LLM turns: an ORM flush per
+turn, one INSERT ... RETURNING per turn, INSERTs coalesced across concurrent turns by the
+MessageWriter, and COPY (for backfills).
+
+The rows are written to a copy of the messages table in a separate `bench` schema (with
+the same indexes, so run the migrations first), which is dropped afterwards unless --keep
+is given. Run with:
+
+    python -m scripts.benchmarks.message_writes --turns 5000 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+from typing import Awaitable, Callable, List
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.database.engine import get_database_url
+from app.database.enums import MessageRole
+from app.database.models import Message
+from app.services.persistence_service import MessageWriter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Unqualified table names resolve to the bench schema
+bench_engine = create_async_engine(
+    get_database_url(),
+    pool_size=20,
+    max_overflow=0,
+    connect_args={"server_settings": {"search_path": "bench"}},
+)
+BenchSession = async_sessionmaker(bench_engine, expire_on_commit=False)
+
+TurnWriter = Callable[[List[Message]], Awaitable[List[Message]]]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_turn(users: int) -> List[Message]:
+    """A tool call, its result and the final answer, like a turn that searched the books."""
+    user_id = random.randint(1, users)
+    tool_call = {
+        "id": f"call_{random.getrandbits(32):08x}",
+        "type": "function",
+        "function": {"name": "search_knowledge", "arguments": '{"search_phrase": "x"}'},
+    }
+    return [
+        Message(user_id=user_id, role=MessageRole.assistant, tool_calls=[tool_call]),
+        Message(
+            user_id=user_id,
+            role=MessageRole.tool,
+            tool_call_id=tool_call["id"],
+            content="retrieved text " * 100,
+        ),
+        Message(user_id=user_id, role=MessageRole.assistant, content="answer " * 60),
+    ]
+
+
+def message_values(message: Message) -> dict:
+    return {
+        column.name: getattr(message, column.name)
+        for column in Message.__table__.columns
+        if column.name != "id"
+    }
+
+
+async def orm_flush(messages: List[Message]) -> List[Message]:
+    # What create_new_messages used to do
+    async with BenchSession() as session:
+        session.add_all(messages)
+        await session.flush()
+        await session.commit()
+    return messages
+
+
+async def bulk_insert(messages: List[Message]) -> List[Message]:
+    # The statement create_new_messages uses
+    async with BenchSession() as session:
+        result = await session.execute(
+            insert(Message).returning(
+                Message.id, Message.created_at, sort_by_parameter_order=True
+            ),
+            [message_values(message) for message in messages],
+        )
+        for message, row in zip(messages, result.all()):
+            message.id = row.id
+        await session.commit()
+    return messages
+
+
+async def copy(messages: List[Message]) -> int:
+    # The same as copy_messages
+    columns = [
+        column.name for column in Message.__table__.columns if column.name != "id"
+    ]
+    records = []
+    for message in messages:
+        values = message_values(message)
+        if values["tool_calls"] is not None:
+            values["tool_calls"] = json.dumps(values["tool_calls"])
+        records.append(tuple(values[column] for column in columns))
+    async with bench_engine.connect() as conn:
+        raw_connection = await conn.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            "messages", records=records, columns=columns
+        )
+        await conn.commit()
+    return len(records)
+
+
+async def run_turns(name: str, write: TurnWriter, args: argparse.Namespace) -> None:
+    turns = [make_turn(args.users) for _ in range(args.turns)]
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def store(turn: List[Message]) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await write(turn)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(store(turn) for turn in turns))
+    elapsed = time.perf_counter() - start
+    rows = sum(len(turn) for turn in turns)
+    logger.info(
+        f"{name}: {rows / elapsed:,.0f} rows/s, turn p50={statistics.median(latencies):.2f}ms "
+        f"p99={percentile(latencies, 99):.2f}ms"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        async with bench_engine.connect() as conn:
+            await conn.execute(text("DROP SCHEMA IF EXISTS bench CASCADE"))
+            await conn.execute(text("CREATE SCHEMA bench"))
+            # Copies the columns and indexes, but not the foreign key to users or the
+            # id sequence (so the benchmark doesn't use up ids of the real table)
+            await conn.execute(
+                text(
+                    "CREATE TABLE bench.messages (LIKE public.messages INCLUDING INDEXES)"
+                )
+            )
+            await conn.execute(
+                text(
+                    "ALTER TABLE bench.messages ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY"
+                )
+            )
+            await conn.commit()
+
+        await run_turns("ORM flush", orm_flush, args)
+        await run_turns("INSERT ... RETURNING", bulk_insert, args)
+        writer = MessageWriter(
+            coalesce_ms=args.coalesce_ms,
+            max_batch=args.max_batch,
+            max_pending=args.concurrency,
+            insert_batch=bulk_insert,
+        )
+        await run_turns(f"Coalesced ({args.coalesce_ms}ms)", writer.write, args)
+        logger.info(f"Coalesced writes: {writer.stats}")
+
+        backfill = [
+            message for _ in range(args.turns) for message in make_turn(args.users)
+        ]
+        start = time.perf_counter()
+        rows = await copy(backfill)
+        logger.info(f"COPY: {rows / (time.perf_counter() - start):,.0f} rows/s")
+
+        if not args.keep:
+            async with bench_engine.connect() as conn:
+                await conn.execute(text("DROP SCHEMA bench CASCADE"))
+                await conn.commit()
+    finally:
+        await bench_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--coalesce-ms", type=int, default=5)
+    parser.add_argument("--max-batch", type=int, default=500)
+    parser.add_argument("--keep", action="store_true", help="Keep the bench schema")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+"""
+Compare webhook acknowledgement latency with and without the inbound message queue.
+
+The LLM pipeline is simulated with a fixed delay so the numbers only depend on how the
+webhook hands work off. Run with:
+
+    python -m scripts.benchmarks.webhook_latency --llm-latency 2.0 --requests 500
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from app.services.queue_service import InboundQueue, QueueFullError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_body(wa_id: str, sequence: int) -> dict:
+    return {"wa_id": wa_id, "sequence": sequence}
+
+
+async def run(mode: str, backend: str, args: argparse.Namespace) -> None:
+    processed: Dict[str, List[int]] = defaultdict(list)
+
+    async def fake_pipeline(body: dict, attempt: int = 1, on_stored=None) -> None:
+        # Stand-in for handle_valid_message: storing the message, then two LLM calls and
+        # tools
+        processed[body["wa_id"]].append(body["sequence"])
+        if on_stored is not None:
+            await on_stored()
+        await asyncio.sleep(args.llm_latency * random.uniform(0.5, 1.5))
+
+    queue = InboundQueue(backend=backend)
+    if mode == "queued":
+        await queue.start(fake_pipeline)
+
+    wa_ids = [f"2557000{i:05d}" for i in range(args.users)]
+    sequences: Dict[str, int] = defaultdict(int)
+    latencies: List[float] = []
+    rejected: Dict[str, int] = defaultdict(int)
+
+    async def webhook(wa_id: str, sequence: int) -> None:
+        start = time.perf_counter()
+        if mode == "queued":
+            try:
+                await queue.put(wa_id, make_body(wa_id, sequence))
+            except QueueFullError:
+                # Answered with 503, WhatsApp would deliver it again later
+                rejected[wa_id] += 1
+        else:
+            await fake_pipeline(make_body(wa_id, sequence))
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    for _ in range(args.requests):
+        wa_id = random.choice(wa_ids)
+        sequences[wa_id] += 1
+        tasks.append(asyncio.create_task(webhook(wa_id, sequences[wa_id])))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+
+    if mode == "queued":
+        await queue.stop(timeout=args.llm_latency * args.requests)
+        out_of_order = [
+            wa_id
+            for wa_id, seen in processed.items()
+            if seen != sorted(seen) or len(seen) + rejected[wa_id] != sequences[wa_id]
+        ]
+        logger.info(f"Users with out of order or missing events: {len(out_of_order)}")
+        logger.info(
+            f"Events rejected because the queue was full: {sum(rejected.values())}"
+        )
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    logger.info(
+        f"{mode:>7} ({backend}): p50={statistics.median(latencies_ms):.2f}ms "
+        f"p99={percentile(latencies_ms, 99):.2f}ms max={max(latencies_ms):.2f}ms"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    logger.info(
+        f"Simulated LLM latency {args.llm_latency}s, {args.requests} requests at {args.rate}/s"
+    )
+    await run("inline", args.backend, args)
+    await run("queued", args.backend, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--llm-latency", type=float, default=2.0)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=100.0)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--backend",
+        choices=["memory", "postgres"],
+        default="memory",
+        help="The postgres backend needs DATABASE_URL and the inbound_events table",
+    )
+    asyncio.run(main(parser.parse_args()))
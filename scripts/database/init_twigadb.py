@@ -20,7 +20,9 @@ from app.database.models import (
     Subject,
 )
 from app.database.enums import ChunkType
+from app.database.engine import db_engine
 from app.config import settings
+from app.services.response_cache_service import response_cache
 from app.utils.embedder import get_embeddings
 
 # Set up logging
@@ -221,6 +223,9 @@ async def inject_vector_data():
                 resource_id=resource_id,
             )
 
+            # Answers cached before these chunks existed may be outdated now
+            await response_cache.invalidate([resource_id])
+
             # Get final count
             final_count = await check_existing_chunks(session, resource_id)
             logger.info(
@@ -232,6 +237,7 @@ async def inject_vector_data():
         raise
     finally:
         await engine.dispose()
+        await db_engine.dispose()
 
 
 def main():